@@ -20,12 +20,12 @@ setup(
     long_description_content_type='text/x-rst',
     install_requires=[
         'discord.py>=1.5.1',
-        'requests-oauthlib>=1.3.0',
         'tornado>=6.1',
         'mysql-connector-python>=8.0.20',
         'skytemple-dtef>=1.6.1',
         'skytemple-files==1.8.3',
-        'pycairo'
+        'pycairo',
+        'Pillow'
     ],
     classifiers=[
         'Development Status :: 4 - Beta',
@@ -0,0 +1,88 @@
+import copy
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, Iterable, TypeVar
+
+from swablu.db import DatabasePool
+
+T = TypeVar('T')
+
+
+def _freeze(value) -> Hashable:
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return tuple(_freeze(v) for v in value)
+    if isinstance(value, dict):
+        return tuple(sorted((k, _freeze(v)) for k, v in value.items()))
+    return value
+
+
+class TaggedCache:
+    """
+    Bounded in-process LRU cache with a TTL per entry.
+
+    Every entry is stored with a list of tags. The tags are the same xkey tags used for Varnish
+    (`hack`, `hack-<key>`, `jam`, `jam-<key>`), so purging Varnish and evicting entries here can use the same list.
+    Values are deep-copied on the way in and out, since handlers modify the rows they get.
+    """
+    def __init__(self, max_entries: int, ttl: float):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries: OrderedDict[Hashable, tuple[float, Any, tuple[str, ...]]] = OrderedDict()
+        self._keys_by_tag: dict[str, set[Hashable]] = {}
+        # Increased on every invalidation. Loads that started before an invalidation are not stored.
+        self._generation = 0
+
+    def get(self, key: Hashable) -> tuple[bool, Any]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return False, None
+        expires, value, _ = entry
+        if expires < time.monotonic():
+            self._remove(key)
+            return False, None
+        self._entries.move_to_end(key)
+        return True, copy.deepcopy(value)
+
+    def set(self, key: Hashable, value: Any, tags: Iterable[str]):
+        if key in self._entries:
+            self._remove(key)
+        tags = tuple(tags)
+        self._entries[key] = (time.monotonic() + self.ttl, copy.deepcopy(value), tags)
+        for tag in tags:
+            self._keys_by_tag.setdefault(tag, set()).add(key)
+        while len(self._entries) > self.max_entries:
+            self._remove(next(iter(self._entries)))
+
+    def invalidate(self, tags: Iterable[str]):
+        self._generation += 1
+        for tag in tags:
+            for key in self._keys_by_tag.pop(tag, set()):
+                self._remove(key)
+
+    def clear(self):
+        self._generation += 1
+        self._entries.clear()
+        self._keys_by_tag.clear()
+
+    async def run(self, db: DatabasePool, tags: Iterable[str], fn: Callable[..., T], *args, **kwargs) -> T:
+        """Read-through wrapper for `db.run(fn, *args, **kwargs)`."""
+        key = (fn.__name__, _freeze(args), _freeze(kwargs))
+        found, value = self.get(key)
+        if found:
+            return value
+        generation = self._generation
+        value = await db.run(fn, *args, **kwargs)
+        if generation == self._generation:
+            self.set(key, value, tags)
+        return value
+
+    def _remove(self, key: Hashable):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        for tag in entry[2]:
+            keys = self._keys_by_tag.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if len(keys) == 0:
+                    del self._keys_by_tag[tag]
@@ -0,0 +1,71 @@
+import gzip
+import hashlib
+from collections import OrderedDict
+from typing import Optional
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Responses smaller than this are sent uncompressed.
+COMPRESSION_MIN_SIZE = 1024
+COMPRESSIBLE_TYPES = ('text/', 'application/json', 'application/javascript', 'image/svg+xml')
+
+
+def supported_encodings() -> list[str]:
+    """Content encodings we can produce, most preferred first."""
+    if brotli is not None:
+        return ['br', 'gzip']
+    return ['gzip']
+
+
+def preferred_encoding(accept_encoding: str) -> Optional[str]:
+    """Picks the best supported encoding the client accepts (per its Accept-Encoding header), if any."""
+    accepted = set()
+    for part in accept_encoding.split(','):
+        name, _, params = part.strip().partition(';')
+        q = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        if q > 0:
+            accepted.add(name.strip().lower())
+    for encoding in supported_encodings():
+        if encoding in accepted or '*' in accepted:
+            return encoding
+    return None
+
+
+def compress(body: bytes, encoding: str) -> bytes:
+    if encoding == 'br':
+        return brotli.compress(body, mode=brotli.MODE_TEXT)
+    # mtime=0 keeps the output (and so ETags computed from it) deterministic.
+    return gzip.compress(body, mtime=0)
+
+
+class CompressedBodyCache:
+    """LRU cache of compressed response bodies, keyed by the hash of the uncompressed body and the encoding."""
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._entries: OrderedDict[tuple[str, str], bytes] = OrderedDict()
+
+    def get(self, body: bytes, encoding: str) -> bytes:
+        key = (hashlib.sha1(body).hexdigest(), encoding)
+        compressed = self._entries.get(key)
+        if compressed is None:
+            compressed = compress(body, encoding)
+            self._entries[key] = compressed
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        else:
+            self._entries.move_to_end(key)
+        return compressed
+
+    def prime(self, body: bytes):
+        """Compresses body with all supported encodings ahead of the first request for it."""
+        for encoding in supported_encodings():
+            self.get(body, encoding)
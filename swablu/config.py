@@ -1,15 +1,23 @@
+import asyncio
+import base64
+import datetime
+import hashlib
 import json
 import logging
 import os
+import tempfile
+from enum import Enum
 from time import sleep
 from typing import Optional
 
 import discord
 import pkg_resources
-import mysql.connector
 from mysql.connector import MySQLConnection, OperationalError
 from mysql.connector.cursor import MySQLCursor
 
+from swablu.cache import TaggedCache
+from swablu.db import DatabasePool
+
 intents = discord.Intents.default()
 # We need this to cache the whole server member list, which is in turn needed to quickly resolve hack author IDs
 # to usernames. We can't afford to do 300+ requests to the "get user by ID" endpoint to load the hack list.
@@ -19,6 +27,11 @@ TABLE_NAME_HACKS = 'rom_hacks'
 TABLE_NAME_AUTHORS = 'hack_authors'
 TABLE_NAME_JAM = 'jam'
 TABLE_NAME_JAM_VOTES = 'jam_votes'
+TABLE_NAME_SCREENSHOTS = 'hack_screenshots'
+TABLE_NAME_SCREENSHOT_VARIANTS = 'hack_screenshot_variants'
+TABLE_NAME_MIGRATIONS = 'schema_migrations'
+TABLE_NAME_DISCORD_USERS = 'discord_users'
+TABLE_NAME_DISCORD_OUTBOX = 'discord_outbox'
 logger = logging.getLogger(__name__)
 
 
@@ -59,6 +72,12 @@ MANAGED_HTACCESS_FILE = os.environ['MANAGED_HTACCESS_FILE']
 if 'BASE_URL' not in os.environ:
     raise ValueError("No env MANAGED_HTACCESS_FILE.")
 BASE_URL = os.environ['BASE_URL']
+VARNISH_HOST = os.getenv('VARNISH_HOST', 'varnish')
+VARNISH_PORT = int(os.getenv('VARNISH_PORT', "80"))
+# Unreferenced screenshots are only deleted once they are older than this many seconds.
+SCREENSHOT_GC_GRACE_PERIOD = 3600
+# Seconds Crowdin webhook events are collected for before they are announced in one message.
+CROWDIN_AGGREGATION_WINDOW = int(os.getenv('CROWDIN_AGGREGATION_WINDOW', "60"))
 
 
 def db_cursor(dbcon: MySQLConnection, **kwargs) -> MySQLCursor:
@@ -74,17 +93,69 @@ def check_table_exists(dbcon, tablename):
     dbcur.execute("""
         SELECT COUNT(*)
         FROM information_schema.tables
-        WHERE table_name = '{0}'
-        """.format(tablename.replace('\'', '\'\'')))
-    if dbcur.fetchone()[0] == 1:
-        dbcur.close()
-        return True
+        WHERE table_schema = DATABASE() AND table_name = %s
+        """, (tablename,))
+    exists = dbcur.fetchone()[0] == 1
+    dbcur.close()
+    return exists
+
+
+def check_column_exists(dbcon, tablename, columnname):
+    dbcur = db_cursor(dbcon)
+    dbcur.execute("""
+        SELECT COUNT(*)
+        FROM information_schema.columns
+        WHERE table_schema = DATABASE() AND table_name = %s AND column_name = %s
+        """, (tablename, columnname))
+    exists = dbcur.fetchone()[0] == 1
+    dbcur.close()
+    return exists
+
+
+def check_index_exists(dbcon, tablename, indexname):
+    dbcur = db_cursor(dbcon)
+    dbcur.execute("""
+        SELECT COUNT(*)
+        FROM information_schema.statistics
+        WHERE table_schema = DATABASE() AND table_name = %s AND index_name = %s
+        """, (tablename, indexname))
+    exists = dbcur.fetchone()[0] > 0
+    dbcur.close()
+    return exists
 
 
-def get_rom_hacks(dbcon, filter_author_id: Optional[int] = None, sorted=False):
+class HackProjection(Enum):
+    """
+    Row shape returned by the hack queries.
+    SUMMARY only selects the columns needed to list and edit hacks and leaves out the legacy `screenshot1` and
+    `screenshot2` columns (base64 data URIs from before the screenshot table existed). Both shapes contain the cheap
+    `has_screenshot1` and `has_screenshot2` flags.
+    """
+    SUMMARY = 0
+    FULL = 1
+
+
+HACK_SUMMARY_COLUMNS = [
+    'id', 'key', 'name', 'description', 'url_main', 'url_discord', 'url_download', 'video', 'hack_type',
+    'message_id', 'message_hash', 'date_updated', 'screenshot1_hash', 'screenshot2_hash'
+]
+
+
+def hack_columns_sql(projection: HackProjection) -> str:
+    flags = (
+        f"`{TABLE_NAME_HACKS}`.`screenshot1_hash` IS NOT NULL AS `has_screenshot1`, "
+        f"`{TABLE_NAME_HACKS}`.`screenshot2_hash` IS NOT NULL AS `has_screenshot2`"
+    )
+    if projection == HackProjection.FULL:
+        return f"`{TABLE_NAME_HACKS}`.*, {flags}"
+    return ", ".join(f"`{TABLE_NAME_HACKS}`.`{c}`" for c in HACK_SUMMARY_COLUMNS) + f", {flags}"
+
+
+def get_rom_hacks(dbcon, filter_author_id: Optional[int] = None, sorted=False,
+                  projection: HackProjection = HackProjection.FULL):
     cursor = db_cursor(dbcon, dictionary=True, buffered=True)
 
-    sql = f"SELECT * FROM `{TABLE_NAME_HACKS}`"
+    sql = f"SELECT {hack_columns_sql(projection)} FROM `{TABLE_NAME_HACKS}`"
     if filter_author_id:
         sql += f" INNER JOIN {TABLE_NAME_AUTHORS} USING (`id`) WHERE author_id = %s"
     if sorted:
@@ -103,9 +174,9 @@ def get_rom_hacks(dbcon, filter_author_id: Optional[int] = None, sorted=False):
     return d
 
 
-def get_rom_hack(dbcon, key):
+def get_rom_hack(dbcon, key, projection: HackProjection = HackProjection.FULL):
     cursor = db_cursor(dbcon, dictionary=True, buffered=True)
-    sql = f"SELECT * FROM `{TABLE_NAME_HACKS}` WHERE `key` = %s"
+    sql = f"SELECT {hack_columns_sql(projection)} FROM `{TABLE_NAME_HACKS}` WHERE `key` = %s"
     cursor.execute(sql, (key,))
     d = cursor.fetchone()
     dbcon.commit()
@@ -113,6 +184,23 @@ def get_rom_hack(dbcon, key):
     return d
 
 
+def get_rom_hacks_by_keys(dbcon, keys: list[str], projection: HackProjection = HackProjection.SUMMARY):
+    if len(keys) < 1:
+        return []
+    cursor = db_cursor(dbcon, dictionary=True, buffered=True)
+    sql = (
+        f"SELECT {hack_columns_sql(projection)} FROM `{TABLE_NAME_HACKS}` "
+        f"WHERE `key` IN ({', '.join(['%s'] * len(keys))})"
+    )
+    cursor.execute(sql, tuple(keys))
+    d = []
+    for k in cursor.fetchall():
+        d.append(k)
+    dbcon.commit()
+    cursor.close()
+    return d
+
+
 def get_rom_hack_id(dbcon, key) -> int:
     cursor = db_cursor(dbcon, dictionary=True, buffered=True)
     sql = f"SELECT id FROM `{TABLE_NAME_HACKS}` WHERE `key` = %s"
@@ -123,25 +211,123 @@ def get_rom_hack_id(dbcon, key) -> int:
     return d['id']
 
 
-def get_rom_hack_img(dbcon, key, id):
+def get_rom_hack_img(dbcon, key, id) -> Optional[dict]:
+    """Returns the hash and MIME type (but not the data) of a hack's screenshot, or None if it has none."""
     field = None
     if int(id) == 1:
-        field = 'screenshot1'
+        field = 'screenshot1_hash'
     elif int(id) == 2:
-        field = 'screenshot2'
+        field = 'screenshot2_hash'
     if field:
         cursor = db_cursor(dbcon, dictionary=True, buffered=True)
-        sql = f"SELECT `{field}` FROM `{TABLE_NAME_HACKS}` WHERE `key` = %s"
+        sql = (
+            f"SELECT s.`hash`, s.`mime` FROM `{TABLE_NAME_HACKS}` "
+            f"INNER JOIN `{TABLE_NAME_SCREENSHOTS}` s ON s.`hash` = `{TABLE_NAME_HACKS}`.`{field}` "
+            "WHERE `key` = %s"
+        )
         cursor.execute(sql, (key,))
         d = cursor.fetchone()
         dbcon.commit()
         cursor.close()
-        v = d[field]
-        if v != 'None':
-            return v
+        return d
     return None
 
 
+def get_screenshot_data(dbcon, hash: str) -> Optional[bytes]:
+    cursor = db_cursor(dbcon, buffered=True)
+    sql = f"SELECT `data` FROM `{TABLE_NAME_SCREENSHOTS}` WHERE `hash` = %s"
+    cursor.execute(sql, (hash,))
+    d = cursor.fetchone()
+    dbcon.commit()
+    cursor.close()
+    if d is None:
+        return None
+    return bytes(d[0])
+
+
+def store_screenshot(dbcon, mime: str, data: bytes) -> str:
+    """
+    Stores the screenshot (if it isn't stored yet) and returns its hash. `created_at` is reset for existing
+    screenshots as well, so they aren't deleted by delete_unused_screenshots before the hack referencing them is saved.
+    """
+    hash = hashlib.sha256(data).hexdigest()
+    cursor = db_cursor(dbcon)
+    sql = (
+        f"INSERT INTO `{TABLE_NAME_SCREENSHOTS}` (`hash`, `mime`, `data`) VALUES(%s, %s, %s) "
+        f"ON DUPLICATE KEY UPDATE `created_at` = CURRENT_TIMESTAMP"
+    )
+    cursor.execute(sql, (hash, mime, data))
+    dbcon.commit()
+    cursor.close()
+    return hash
+
+
+def delete_unused_screenshots(dbcon):
+    """
+    Deletes screenshots no hack references. Screenshots stored within the last SCREENSHOT_GC_GRACE_PERIOD seconds
+    are kept, since the hack they were uploaded for may not be saved yet.
+    """
+    cursor = db_cursor(dbcon)
+    sql = (
+        f"DELETE FROM `{TABLE_NAME_SCREENSHOTS}` WHERE `created_at` < NOW() - INTERVAL %s SECOND AND `hash` NOT IN ("
+        f"SELECT `screenshot1_hash` FROM `{TABLE_NAME_HACKS}` WHERE `screenshot1_hash` IS NOT NULL UNION "
+        f"SELECT `screenshot2_hash` FROM `{TABLE_NAME_HACKS}` WHERE `screenshot2_hash` IS NOT NULL)"
+    )
+    cursor.execute(sql, (SCREENSHOT_GC_GRACE_PERIOD,))
+    sql = (
+        f"DELETE FROM `{TABLE_NAME_SCREENSHOT_VARIANTS}` WHERE `hash` NOT IN ("
+        f"SELECT `hash` FROM `{TABLE_NAME_SCREENSHOTS}`)"
+    )
+    cursor.execute(sql)
+    dbcon.commit()
+    cursor.close()
+
+
+def get_screenshot_variants(dbcon, hash: str) -> dict[str, str]:
+    """Returns the MIME types of the derivatives generated for a screenshot, by variant name."""
+    cursor = db_cursor(dbcon, buffered=True)
+    sql = f"SELECT `variant`, `mime` FROM `{TABLE_NAME_SCREENSHOT_VARIANTS}` WHERE `hash` = %s"
+    cursor.execute(sql, (hash,))
+    d = {variant: mime for variant, mime in cursor.fetchall()}
+    dbcon.commit()
+    cursor.close()
+    return d
+
+
+def get_screenshot_variant_data(dbcon, hash: str, variant: str) -> Optional[bytes]:
+    cursor = db_cursor(dbcon, buffered=True)
+    sql = f"SELECT `data` FROM `{TABLE_NAME_SCREENSHOT_VARIANTS}` WHERE `hash` = %s AND `variant` = %s"
+    cursor.execute(sql, (hash, variant))
+    d = cursor.fetchone()
+    dbcon.commit()
+    cursor.close()
+    if d is None:
+        return None
+    return bytes(d[0])
+
+
+def store_screenshot_variants(dbcon, hash: str, variants: list[tuple[str, str, bytes]]):
+    """Stores (variant, mime, data) derivatives of a screenshot, replacing existing ones."""
+    cursor = db_cursor(dbcon)
+    sql = f"REPLACE INTO `{TABLE_NAME_SCREENSHOT_VARIANTS}` (`hash`, `variant`, `mime`, `data`) VALUES(%s, %s, %s, %s)"
+    cursor.executemany(sql, [(hash, variant, mime, data) for variant, mime, data in variants])
+    dbcon.commit()
+    cursor.close()
+
+
+def get_screenshots_without_variants(dbcon) -> list[str]:
+    cursor = db_cursor(dbcon, buffered=True)
+    sql = (
+        f"SELECT `hash` FROM `{TABLE_NAME_SCREENSHOTS}` WHERE `hash` NOT IN ("
+        f"SELECT `hash` FROM `{TABLE_NAME_SCREENSHOT_VARIANTS}`)"
+    )
+    cursor.execute(sql)
+    d = [row[0] for row in cursor.fetchall()]
+    dbcon.commit()
+    cursor.close()
+    return d
+
+
 def get_hack_authors(dbcon, hack_key: str) -> list[int]:
     cursor = db_cursor(dbcon, dictionary=True, buffered=True)
     sql = (
@@ -158,15 +344,61 @@ def get_hack_authors(dbcon, hack_key: str) -> list[int]:
     return d
 
 
-def get_jams(dbcon):
+def get_hacks_authors(dbcon, hack_keys: Optional[list[str]] = None) -> dict[str, list[int]]:
+    """Returns the author IDs of all hacks (or of the given hacks), keyed by hack key, using a single query."""
+    if hack_keys is not None and len(hack_keys) < 1:
+        return {}
     cursor = db_cursor(dbcon, dictionary=True, buffered=True)
-    sql = f"SELECT * FROM `{TABLE_NAME_JAM}`"
-    cursor.execute(sql)
-    rows = []
+    sql = (
+        f"SELECT `key`, author_id FROM {TABLE_NAME_HACKS} "
+        f"INNER JOIN {TABLE_NAME_AUTHORS} USING (`id`)"
+    )
+    if hack_keys is not None:
+        sql += f" WHERE `key` IN ({', '.join(['%s'] * len(hack_keys))})"
+        cursor.execute(sql, tuple(hack_keys))
+    else:
+        cursor.execute(sql)
+    d = {}
     for k in cursor.fetchall():
-        d = json.loads(k['config'])
-        d['key'] = k['key']
-        rows.append(d)
+        d.setdefault(k['key'], []).append(k['author_id'])
+    dbcon.commit()
+    cursor.close()
+    return d
+
+
+def get_discord_users(dbcon) -> list[dict]:
+    """Returns all cached Discord user identities (user_id, name, discriminator, fetched_at)."""
+    cursor = db_cursor(dbcon, dictionary=True, buffered=True)
+    sql = f"SELECT `user_id`, `name`, `discriminator`, `fetched_at` FROM `{TABLE_NAME_DISCORD_USERS}`"
+    cursor.execute(sql)
+    d = cursor.fetchall()
+    dbcon.commit()
+    cursor.close()
+    return d
+
+
+def store_discord_users(dbcon, users: list[tuple[int, str, str]]):
+    """Stores (user_id, name, discriminator) identities, marking them as fetched now."""
+    if len(users) < 1:
+        return
+    cursor = db_cursor(dbcon)
+    sql = (
+        f"INSERT INTO `{TABLE_NAME_DISCORD_USERS}` (`user_id`, `name`, `discriminator`, `fetched_at`) "
+        f"VALUES(%s, %s, %s, UTC_TIMESTAMP()) "
+        f"ON DUPLICATE KEY UPDATE `name` = VALUES(`name`), `discriminator` = VALUES(`discriminator`), "
+        f"`fetched_at` = VALUES(`fetched_at`)"
+    )
+    cursor.executemany(sql, users)
+    dbcon.commit()
+    cursor.close()
+
+
+def get_jam_configs(dbcon) -> list[tuple[str, str]]:
+    """Returns the (key, config) of all jams, with the configs still JSON-encoded."""
+    cursor = db_cursor(dbcon, buffered=True)
+    sql = f"SELECT `key`, `config` FROM `{TABLE_NAME_JAM}` ORDER BY `id`"
+    cursor.execute(sql)
+    rows = [(key, config) for key, config in cursor.fetchall()]
     dbcon.commit()
     cursor.close()
     return rows
@@ -186,7 +418,10 @@ def jam_exists(dbcon, key):
     cursor = db_cursor(dbcon, dictionary=True, buffered=True)
     sql = f"SELECT * FROM `{TABLE_NAME_JAM}` WHERE `key` = %s"
     cursor.execute(sql, (key,))
-    return cursor.fetchone() is not None
+    exists = cursor.fetchone() is not None
+    dbcon.commit()
+    cursor.close()
+    return exists
 
 
 def create_jam(dbcon, jam_key, config):
@@ -220,6 +455,7 @@ def vote_jam(dbcon, jam_key, user_id, hack):
 
 
 def update_hack(dbcon, hack, silent=False):
+    # `message_id` and `message_hash` are only written by the Discord outbox (set_hack_message).
     cursor = db_cursor(dbcon)
     date_updated_update = ""
     if not silent:
@@ -227,32 +463,145 @@ def update_hack(dbcon, hack, silent=False):
     sql = f"UPDATE `{TABLE_NAME_HACKS}` SET " \
           f"`name` = %s," \
           f"`description` = %s," \
-          f"`screenshot1` = %s," \
-          f"`screenshot2` = %s," \
+          f"`screenshot1_hash` = %s," \
+          f"`screenshot2_hash` = %s," \
           f"`url_main` = %s," \
           f"`url_discord` = %s," \
           f"`url_download` = %s," \
           f"`video` = %s," \
-          f"`hack_type` = %s," \
-          f"`message_id` = %s{date_updated_update}" \
+          f"`hack_type` = %s{date_updated_update}" \
           f" WHERE id = %s"
     cursor.execute(sql, (
         hack['name'],
         hack['description'],
-        hack['screenshot1'],
-        hack['screenshot2'],
+        hack['screenshot1_hash'],
+        hack['screenshot2_hash'],
         hack['url_main'],
         hack['url_discord'],
         hack['url_download'],
         hack['video'],
         hack['hack_type'],
-        hack['message_id'],
         hack['id']
     ))
     dbcon.commit()
     cursor.close()
 
 
+def set_hack_message_hash(dbcon, hack_key: str, message_hash: Optional[str]):
+    cursor = db_cursor(dbcon)
+    sql = f"UPDATE `{TABLE_NAME_HACKS}` SET `message_hash` = %s WHERE `key` = %s"
+    cursor.execute(sql, (message_hash, hack_key))
+    dbcon.commit()
+    cursor.close()
+
+
+def set_hack_message(dbcon, hack_key: str, message_id: int, message_hash: str):
+    cursor = db_cursor(dbcon)
+    sql = f"UPDATE `{TABLE_NAME_HACKS}` SET `message_id` = %s, `message_hash` = %s WHERE `key` = %s"
+    cursor.execute(sql, (message_id, message_hash, hack_key))
+    dbcon.commit()
+    cursor.close()
+
+
+def enqueue_discord_write(dbcon, hack_key: str):
+    """Queues an update of the hack's message. Pending updates of the same hack are merged."""
+    cursor = db_cursor(dbcon)
+    sql = (
+        f"INSERT INTO `{TABLE_NAME_DISCORD_OUTBOX}` (`hack_key`, `status`, `version`, `attempts`, `next_attempt_at`, "
+        f"`updated_at`) VALUES(%s, 'pending', 1, 0, UTC_TIMESTAMP(), UTC_TIMESTAMP()) "
+        f"ON DUPLICATE KEY UPDATE `status` = 'pending', `version` = `version` + 1, `attempts` = 0, "
+        f"`next_attempt_at` = UTC_TIMESTAMP(), `last_error` = NULL, `updated_at` = UTC_TIMESTAMP()"
+    )
+    cursor.execute(sql, (hack_key,))
+    dbcon.commit()
+    cursor.close()
+
+
+def get_due_discord_writes(dbcon) -> list[dict]:
+    cursor = db_cursor(dbcon, dictionary=True, buffered=True)
+    sql = (
+        f"SELECT * FROM `{TABLE_NAME_DISCORD_OUTBOX}` "
+        f"WHERE `status` = 'pending' AND `next_attempt_at` <= UTC_TIMESTAMP() ORDER BY `next_attempt_at`"
+    )
+    cursor.execute(sql)
+    d = cursor.fetchall()
+    dbcon.commit()
+    cursor.close()
+    return d
+
+
+def get_next_discord_write_time(dbcon) -> Optional[datetime.datetime]:
+    """Returns when the next pending write is due (in UTC), or None if there is none."""
+    cursor = db_cursor(dbcon, buffered=True)
+    sql = f"SELECT MIN(`next_attempt_at`) FROM `{TABLE_NAME_DISCORD_OUTBOX}` WHERE `status` = 'pending'"
+    cursor.execute(sql)
+    d = cursor.fetchone()[0]
+    dbcon.commit()
+    cursor.close()
+    return d
+
+
+def finish_discord_write(dbcon, hack_key: str, version: int):
+    """Marks the write as done, unless it was queued again (and so got a new version) in the meantime."""
+    cursor = db_cursor(dbcon)
+    sql = (
+        f"UPDATE `{TABLE_NAME_DISCORD_OUTBOX}` SET `status` = 'done', `updated_at` = UTC_TIMESTAMP() "
+        f"WHERE `hack_key` = %s AND `version` = %s"
+    )
+    cursor.execute(sql, (hack_key, version))
+    dbcon.commit()
+    cursor.close()
+
+
+def fail_discord_write(dbcon, hack_key: str, version: int, error: str, backoff: int, max_attempts: int):
+    """Records a failed attempt and schedules the next one in backoff seconds, or gives up after max_attempts."""
+    cursor = db_cursor(dbcon)
+    # MySQL applies the assignments in order, so `status` sees the increased `attempts`.
+    sql = (
+        f"UPDATE `{TABLE_NAME_DISCORD_OUTBOX}` SET `attempts` = `attempts` + 1, "
+        f"`status` = IF(`attempts` >= %s, 'failed', 'pending'), `last_error` = %s, "
+        f"`next_attempt_at` = DATE_ADD(UTC_TIMESTAMP(), INTERVAL %s SECOND), `updated_at` = UTC_TIMESTAMP() "
+        f"WHERE `hack_key` = %s AND `version` = %s"
+    )
+    cursor.execute(sql, (max_attempts, error[:1000], backoff, hack_key, version))
+    dbcon.commit()
+    cursor.close()
+
+
+def get_discord_write(dbcon, hack_key: str) -> Optional[dict]:
+    cursor = db_cursor(dbcon, dictionary=True, buffered=True)
+    sql = f"SELECT * FROM `{TABLE_NAME_DISCORD_OUTBOX}` WHERE `hack_key` = %s"
+    cursor.execute(sql, (hack_key,))
+    d = cursor.fetchone()
+    dbcon.commit()
+    cursor.close()
+    return d
+
+
+def get_open_discord_writes(dbcon) -> list[dict]:
+    """Returns all pending and failed writes."""
+    cursor = db_cursor(dbcon, dictionary=True, buffered=True)
+    sql = f"SELECT * FROM `{TABLE_NAME_DISCORD_OUTBOX}` WHERE `status` != 'done' ORDER BY `updated_at`"
+    cursor.execute(sql)
+    d = cursor.fetchall()
+    dbcon.commit()
+    cursor.close()
+    return d
+
+
+def retry_failed_discord_writes(dbcon) -> int:
+    cursor = db_cursor(dbcon)
+    sql = (
+        f"UPDATE `{TABLE_NAME_DISCORD_OUTBOX}` SET `status` = 'pending', `attempts` = 0, "
+        f"`next_attempt_at` = UTC_TIMESTAMP(), `updated_at` = UTC_TIMESTAMP() WHERE `status` = 'failed'"
+    )
+    cursor.execute(sql)
+    count = cursor.rowcount
+    dbcon.commit()
+    cursor.close()
+    return count
+
+
 def update_hack_authors(dbcon, hack_key: str, author_list: list[int]):
     cursor = db_cursor(dbcon)
 
@@ -281,101 +630,360 @@ def update_hack_authors(dbcon, hack_key: str, author_list: list[int]):
     cursor.close()
 
 
-def regenerate_htaccess():
+def get_rom_hack_keys(dbcon) -> list[str]:
+    cursor = db_cursor(dbcon, buffered=True)
+    cursor.execute(f"SELECT `key` FROM `{TABLE_NAME_HACKS}`")
+    d = [k[0] for k in cursor.fetchall()]
+    dbcon.commit()
+    cursor.close()
+    return d
+
+
+# Keys the htaccess file was last written for.
+_htaccess_keys: Optional[frozenset[str]] = None
+_htaccess_dirty = False
+_htaccess_task: Optional[asyncio.Task] = None
+# Seconds to wait for further changes before rewriting the htaccess file.
+HTACCESS_DEBOUNCE = 2
+
+
+def regenerate_htaccess(dbcon):
+    """Rewrites the htaccess file if the set of hack keys changed since it was last written."""
+    global _htaccess_keys
+    keys = frozenset(get_rom_hack_keys(dbcon))
+    if keys == _htaccess_keys:
+        return
     logger.info("Regenerating htaccess...")
-    with open(MANAGED_HTACCESS_FILE, 'w') as f:
-        for hack in get_rom_hacks(database):
-            f.write(f"RedirectMatch 301 (?i)/{hack['key']}$/? {BASE_URL}/h/{hack['key']}\n")
+    content = "".join(f"RedirectMatch 301 (?i)/{key}$/? {BASE_URL}/h/{key}\n" for key in sorted(keys))
+    tmp_path = None
+    try:
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(MANAGED_HTACCESS_FILE)),
+                                        prefix='.htaccess.', suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            f.write(content)
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, MANAGED_HTACCESS_FILE)
+    except OSError as ex:
+        # Renaming onto a file that is bind-mounted on its own (e.g. as a Docker volume) isn't possible.
+        logger.warning(f"Could not atomically replace the htaccess file, writing it in place: {ex}")
+        if tmp_path is not None and os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        with open(MANAGED_HTACCESS_FILE, 'w') as f:
+            f.write(content)
+    _htaccess_keys = keys
+
+
+def schedule_htaccess_regeneration():
+    """Regenerates the htaccess file in the background. Calls within HTACCESS_DEBOUNCE seconds are coalesced."""
+    global _htaccess_dirty, _htaccess_task
+    _htaccess_dirty = True
+    if _htaccess_task is None or _htaccess_task.done():
+        _htaccess_task = asyncio.ensure_future(_regenerate_htaccess_debounced())
+
+
+async def _regenerate_htaccess_debounced():
+    global _htaccess_dirty
+    while _htaccess_dirty:
+        await asyncio.sleep(HTACCESS_DEBOUNCE)
+        _htaccess_dirty = False
+        try:
+            await database.run(regenerate_htaccess)
+        except Exception as ex:
+            logger.error("Regenerating htaccess failed.", exc_info=ex)
 
 
 logger.info("Connect to DB...")
 database = None
 while database is None:
     try:
-        database: MySQLConnection = mysql.connector.connect(user=os.environ['MYSQL_USER'], password=os.environ['MYSQL_PASSWORD'],
-                                                            host=os.environ['MYSQL_HOST'], port=os.environ['MYSQL_PORT'],
-                                                            database=os.environ['MYSQL_DATABASE'])
+        database: DatabasePool = DatabasePool(int(os.getenv('MYSQL_POOL_SIZE', "5")),
+                                              user=os.environ['MYSQL_USER'], password=os.environ['MYSQL_PASSWORD'],
+                                              host=os.environ['MYSQL_HOST'], port=os.environ['MYSQL_PORT'],
+                                              database=os.environ['MYSQL_DATABASE'])
     except Exception as ex:
         logger.warning("Connecting failed. Retrying...", exc_info=ex)
         sleep(5)
 
-if not check_table_exists(database, TABLE_NAME_HACKS):
-    dbcur = db_cursor(database)
-    logger.info("Creating hacks table...")
-    # Could surely be optimized, but fine for now.
-    dbcur.execute(f"""
-    CREATE TABLE `{TABLE_NAME_HACKS}` (
-        `id` INT(10) unsigned NOT NULL AUTO_INCREMENT,
-        `key` VARCHAR(80) CHARACTER SET utf8 COLLATE utf8_bin NOT NULL,
-        `name` VARCHAR(100) CHARACTER SET utf8 COLLATE utf8_bin,
-        `description` TEXT CHARACTER SET utf8 COLLATE utf8_bin,
-        `screenshot1` LONGTEXT CHARACTER SET ascii,
-        `screenshot2` LONGTEXT CHARACTER SET ascii,
-        `url_main` VARCHAR(200) CHARACTER SET utf8 COLLATE utf8_bin,
-        `url_discord` VARCHAR(200) CHARACTER SET utf8 COLLATE utf8_bin,
-        `url_download` VARCHAR(200) CHARACTER SET utf8 COLLATE utf8_bin,
-        `video` VARCHAR(100) CHARACTER SET utf8 COLLATE utf8_bin,
-        `hack_type` VARCHAR(32) CHARACTER SET utf8 COLLATE utf8_bin,
-        `message_id` BIGINT(30) unsigned,
-        PRIMARY KEY (`id`),
-        INDEX (`key`)
-    );
-    """)
-    dbcur.close()
-else:
-    logger.info("Hacks table existed!")
-
-if not check_table_exists(database, TABLE_NAME_AUTHORS):
-    dbcur = db_cursor(database)
-    logger.info("Creating authors table...")
-    # Could surely be optimized, but fine for now.
-    dbcur.execute(f"""
-    CREATE TABLE `{TABLE_NAME_AUTHORS}` (
-        `id` INT(10) unsigned NOT NULL,
-        `author_id` BIGINT(30) unsigned NOT NULL,
-        PRIMARY KEY (`id`, `author_id`)
-    );
-    """)
-    dbcur.close()
-else:
-    logger.info("Authors table existed!")
-
-if not check_table_exists(database, TABLE_NAME_JAM):
-    dbcur = db_cursor(database)
-    logger.info("Creating jam table...")
-    dbcur.execute(f"""
-    CREATE TABLE `{TABLE_NAME_JAM}` (
-        `id` INT(10) unsigned NOT NULL AUTO_INCREMENT,
-        `key` VARCHAR(80) CHARACTER SET utf8 COLLATE utf8_bin NOT NULL,
-        `config` TEXT CHARACTER SET utf8 COLLATE utf8_bin,
-        PRIMARY KEY (`id`)
-    );
-    """)
-    dbcur.close()
-else:
-    logger.info("Jam table existed!")
-
-if not check_table_exists(database, TABLE_NAME_JAM_VOTES):
-    dbcur = db_cursor(database)
-    logger.info("Creating jam votes table...")
-    dbcur.execute(f"""
-    CREATE TABLE `{TABLE_NAME_JAM_VOTES}` (
-        `user_id` BIGINT(30) unsigned,
-        `jam` VARCHAR(80) CHARACTER SET utf8 COLLATE utf8_bin NOT NULL,
-        `hack` VARCHAR(80) CHARACTER SET utf8 COLLATE utf8_bin NOT NULL,
-        PRIMARY KEY (`user_id`, `jam`)
-    );
-    """)
+# Read-through cache for hack and jam queries. Entries are evicted by the same tags used to purge Varnish.
+query_cache = TaggedCache(max_entries=int(os.getenv('QUERY_CACHE_SIZE', "1024")),
+                          ttl=int(os.getenv('QUERY_CACHE_TTL', "300")))
+
+
+def _migration_initial_tables(dbcon):
+    if not check_table_exists(dbcon, TABLE_NAME_HACKS):
+        dbcur = db_cursor(dbcon)
+        logger.info("Creating hacks table...")
+        dbcur.execute(f"""
+        CREATE TABLE `{TABLE_NAME_HACKS}` (
+            `id` INT(10) unsigned NOT NULL AUTO_INCREMENT,
+            `key` VARCHAR(80) CHARACTER SET utf8 COLLATE utf8_bin NOT NULL,
+            `name` VARCHAR(100) CHARACTER SET utf8 COLLATE utf8_bin,
+            `description` TEXT CHARACTER SET utf8 COLLATE utf8_bin,
+            `screenshot1` LONGTEXT CHARACTER SET ascii,
+            `screenshot2` LONGTEXT CHARACTER SET ascii,
+            `url_main` VARCHAR(200) CHARACTER SET utf8 COLLATE utf8_bin,
+            `url_discord` VARCHAR(200) CHARACTER SET utf8 COLLATE utf8_bin,
+            `url_download` VARCHAR(200) CHARACTER SET utf8 COLLATE utf8_bin,
+            `video` VARCHAR(100) CHARACTER SET utf8 COLLATE utf8_bin,
+            `hack_type` VARCHAR(32) CHARACTER SET utf8 COLLATE utf8_bin,
+            `message_id` BIGINT(30) unsigned,
+            PRIMARY KEY (`id`),
+            INDEX (`key`)
+        );
+        """)
+        dbcur.close()
+
+    if not check_table_exists(dbcon, TABLE_NAME_AUTHORS):
+        dbcur = db_cursor(dbcon)
+        logger.info("Creating authors table...")
+        dbcur.execute(f"""
+        CREATE TABLE `{TABLE_NAME_AUTHORS}` (
+            `id` INT(10) unsigned NOT NULL,
+            `author_id` BIGINT(30) unsigned NOT NULL,
+            PRIMARY KEY (`id`, `author_id`)
+        );
+        """)
+        dbcur.close()
+
+    if not check_table_exists(dbcon, TABLE_NAME_JAM):
+        dbcur = db_cursor(dbcon)
+        logger.info("Creating jam table...")
+        dbcur.execute(f"""
+        CREATE TABLE `{TABLE_NAME_JAM}` (
+            `id` INT(10) unsigned NOT NULL AUTO_INCREMENT,
+            `key` VARCHAR(80) CHARACTER SET utf8 COLLATE utf8_bin NOT NULL,
+            `config` TEXT CHARACTER SET utf8 COLLATE utf8_bin,
+            PRIMARY KEY (`id`)
+        );
+        """)
+        dbcur.close()
+
+    if not check_table_exists(dbcon, TABLE_NAME_JAM_VOTES):
+        dbcur = db_cursor(dbcon)
+        logger.info("Creating jam votes table...")
+        dbcur.execute(f"""
+        CREATE TABLE `{TABLE_NAME_JAM_VOTES}` (
+            `user_id` BIGINT(30) unsigned,
+            `jam` VARCHAR(80) CHARACTER SET utf8 COLLATE utf8_bin NOT NULL,
+            `hack` VARCHAR(80) CHARACTER SET utf8 COLLATE utf8_bin NOT NULL,
+            PRIMARY KEY (`user_id`, `jam`)
+        );
+        """)
+        dbcur.close()
+
+
+def _migration_date_updated(dbcon):
+    # Older installations added this column by hand; it was never part of the CREATE TABLE statement.
+    if not check_column_exists(dbcon, TABLE_NAME_HACKS, 'date_updated'):
+        dbcur = db_cursor(dbcon)
+        dbcur.execute(f"ALTER TABLE `{TABLE_NAME_HACKS}` ADD COLUMN `date_updated` DATETIME NULL")
+        dbcur.close()
+
+
+def _migration_screenshot_tables(dbcon):
+    if not check_table_exists(dbcon, TABLE_NAME_SCREENSHOTS):
+        dbcur = db_cursor(dbcon)
+        logger.info("Creating screenshots table...")
+        dbcur.execute(f"""
+        CREATE TABLE `{TABLE_NAME_SCREENSHOTS}` (
+            `hash` CHAR(64) CHARACTER SET ascii NOT NULL,
+            `mime` VARCHAR(32) CHARACTER SET ascii NOT NULL,
+            `data` MEDIUMBLOB NOT NULL,
+            PRIMARY KEY (`hash`)
+        );
+        """)
+        dbcur.close()
+
+    if not check_column_exists(dbcon, TABLE_NAME_HACKS, 'screenshot1_hash'):
+        dbcur = db_cursor(dbcon)
+        logger.info("Adding screenshot hash columns to hacks table...")
+        dbcur.execute(f"""
+        ALTER TABLE `{TABLE_NAME_HACKS}`
+            ADD COLUMN `screenshot1_hash` CHAR(64) CHARACTER SET ascii NULL,
+            ADD COLUMN `screenshot2_hash` CHAR(64) CHARACTER SET ascii NULL;
+        """)
+        dbcur.close()
+
+
+def _migration_screenshot_variants(dbcon):
+    if not check_table_exists(dbcon, TABLE_NAME_SCREENSHOT_VARIANTS):
+        dbcur = db_cursor(dbcon)
+        logger.info("Creating screenshot variants table...")
+        dbcur.execute(f"""
+        CREATE TABLE `{TABLE_NAME_SCREENSHOT_VARIANTS}` (
+            `hash` CHAR(64) CHARACTER SET ascii NOT NULL,
+            `variant` VARCHAR(32) CHARACTER SET ascii NOT NULL,
+            `mime` VARCHAR(32) CHARACTER SET ascii NOT NULL,
+            `data` MEDIUMBLOB NOT NULL,
+            PRIMARY KEY (`hash`, `variant`)
+        );
+        """)
+        dbcur.close()
+
+
+def _migration_query_indexes(dbcon):
+    dbcur = db_cursor(dbcon)
+    if not check_index_exists(dbcon, TABLE_NAME_HACKS, 'uq_key'):
+        # Replaces the plain index on `key`. Fails if there are duplicate keys, which have to be resolved by hand.
+        dbcur.execute(f"ALTER TABLE `{TABLE_NAME_HACKS}` ADD UNIQUE INDEX `uq_key` (`key`)")
+    if check_index_exists(dbcon, TABLE_NAME_HACKS, 'key'):
+        dbcur.execute(f"ALTER TABLE `{TABLE_NAME_HACKS}` DROP INDEX `key`")
+    if not check_index_exists(dbcon, TABLE_NAME_HACKS, 'idx_date_updated'):
+        # For the sorted hack list (ORDER BY date_updated DESC, name ASC).
+        dbcur.execute(f"ALTER TABLE `{TABLE_NAME_HACKS}` ADD INDEX `idx_date_updated` (`date_updated` DESC, `name`)")
+    if not check_index_exists(dbcon, TABLE_NAME_AUTHORS, 'idx_author_id'):
+        dbcur.execute(f"ALTER TABLE `{TABLE_NAME_AUTHORS}` ADD INDEX `idx_author_id` (`author_id`, `id`)")
+    if not check_index_exists(dbcon, TABLE_NAME_JAM_VOTES, 'idx_jam_hack'):
+        dbcur.execute(f"ALTER TABLE `{TABLE_NAME_JAM_VOTES}` ADD INDEX `idx_jam_hack` (`jam`, `hack`)")
     dbcur.close()
-else:
-    logger.info("Jam votes table existed!")
+
+
+def migrate_legacy_screenshots(dbcon):
+    """
+    Moves screenshots still stored as base64 data URIs in the hacks table into the screenshots table.
+    Rows are migrated one at a time to keep memory usage low.
+    """
+    for field in ('screenshot1', 'screenshot2'):
+        cursor = db_cursor(dbcon, buffered=True)
+        cursor.execute(f"SELECT `id` FROM `{TABLE_NAME_HACKS}` WHERE `{field}` IS NOT NULL")
+        ids = [row[0] for row in cursor.fetchall()]
+        cursor.close()
+        for hack_id in ids:
+            cursor = db_cursor(dbcon, buffered=True)
+            cursor.execute(f"SELECT `{field}` FROM `{TABLE_NAME_HACKS}` WHERE `id` = %s", (hack_id,))
+            value = cursor.fetchone()[0]
+            if value != 'None' and value.startswith('data:'):
+                prefix, data = value.split(',', 1)
+                data = base64.b64decode(data)
+                hash = hashlib.sha256(data).hexdigest()
+                # Not using store_screenshot, `created_at` doesn't exist yet at this point.
+                cursor.execute(
+                    f"INSERT IGNORE INTO `{TABLE_NAME_SCREENSHOTS}` (`hash`, `mime`, `data`) VALUES(%s, %s, %s)",
+                    (hash, prefix.split(':')[1].split(';')[0], data)
+                )
+                cursor.execute(
+                    f"UPDATE `{TABLE_NAME_HACKS}` SET `{field}` = NULL, `{field}_hash` = %s WHERE `id` = %s",
+                    (hash, hack_id)
+                )
+            else:
+                cursor.execute(f"UPDATE `{TABLE_NAME_HACKS}` SET `{field}` = NULL WHERE `id` = %s", (hack_id,))
+            dbcon.commit()
+            cursor.close()
+            logger.info(f"Migrated {field} of hack {hack_id}.")
+
+
+def _migration_discord_users(dbcon):
+    if not check_table_exists(dbcon, TABLE_NAME_DISCORD_USERS):
+        dbcur = db_cursor(dbcon)
+        logger.info("Creating Discord users table...")
+        dbcur.execute(f"""
+        CREATE TABLE `{TABLE_NAME_DISCORD_USERS}` (
+            `user_id` BIGINT(30) unsigned NOT NULL,
+            `name` VARCHAR(100) CHARACTER SET utf8mb4 COLLATE utf8mb4_bin NOT NULL,
+            `discriminator` VARCHAR(4) CHARACTER SET ascii NOT NULL,
+            `fetched_at` DATETIME NOT NULL,
+            PRIMARY KEY (`user_id`)
+        );
+        """)
+        dbcur.close()
+
+
+def _migration_message_hash(dbcon):
+    if not check_column_exists(dbcon, TABLE_NAME_HACKS, 'message_hash'):
+        dbcur = db_cursor(dbcon)
+        dbcur.execute(f"ALTER TABLE `{TABLE_NAME_HACKS}` ADD COLUMN `message_hash` CHAR(40) CHARACTER SET ascii NULL")
+        dbcur.close()
+
+
+def _migration_discord_outbox(dbcon):
+    if not check_table_exists(dbcon, TABLE_NAME_DISCORD_OUTBOX):
+        dbcur = db_cursor(dbcon)
+        logger.info("Creating Discord outbox table...")
+        dbcur.execute(f"""
+        CREATE TABLE `{TABLE_NAME_DISCORD_OUTBOX}` (
+            `hack_key` VARCHAR(80) CHARACTER SET utf8 COLLATE utf8_bin NOT NULL,
+            `status` VARCHAR(16) CHARACTER SET ascii NOT NULL,
+            `version` INT(10) unsigned NOT NULL,
+            `attempts` INT(10) unsigned NOT NULL,
+            `next_attempt_at` DATETIME NOT NULL,
+            `last_error` TEXT CHARACTER SET utf8mb4,
+            `updated_at` DATETIME NOT NULL,
+            PRIMARY KEY (`hack_key`),
+            INDEX `idx_status_next_attempt` (`status`, `next_attempt_at`)
+        );
+        """)
+        dbcur.close()
+
+
+def _migration_screenshot_created_at(dbcon):
+    if not check_column_exists(dbcon, TABLE_NAME_SCREENSHOTS, 'created_at'):
+        dbcur = db_cursor(dbcon)
+        dbcur.execute(f"ALTER TABLE `{TABLE_NAME_SCREENSHOTS}` "
+                      f"ADD COLUMN `created_at` DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP")
+        dbcur.close()
+
+
+# Schema migrations as (version, description, function). They are applied in order and recorded in
+# TABLE_NAME_MIGRATIONS. Append new migrations with the next version; never change or reorder applied ones.
+# Migrations must be safe to run again, since MySQL commits DDL statements implicitly and a migration that failed
+# halfway will be re-run from the start.
+MIGRATIONS = [
+    (1, "Create the initial tables", _migration_initial_tables),
+    (2, "Add rom_hacks.date_updated", _migration_date_updated),
+    (3, "Move screenshots into their own table", _migration_screenshot_tables),
+    (4, "Create the screenshot variants table", _migration_screenshot_variants),
+    (5, "Migrate legacy base64 screenshots", migrate_legacy_screenshots),
+    (6, "Add indexes for the hack list, author and jam vote queries", _migration_query_indexes),
+    (7, "Create the Discord users table", _migration_discord_users),
+    (8, "Add rom_hacks.message_hash", _migration_message_hash),
+    (9, "Create the Discord outbox table", _migration_discord_outbox),
+    (10, "Add hack_screenshots.created_at", _migration_screenshot_created_at),
+]
+
+
+def run_migrations(dbcon):
+    """Applies all pending schema migrations. A database lock keeps concurrently starting instances apart."""
+    dbcur = db_cursor(dbcon, buffered=True)
+    dbcur.execute("SELECT GET_LOCK('swablu_migrations', 300)")
+    if dbcur.fetchone()[0] != 1:
+        raise RuntimeError("Could not acquire the migration lock.")
+    try:
+        dbcur.execute(f"""
+        CREATE TABLE IF NOT EXISTS `{TABLE_NAME_MIGRATIONS}` (
+            `version` INT(10) unsigned NOT NULL,
+            `description` VARCHAR(200) CHARACTER SET utf8 NOT NULL,
+            `applied_at` DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (`version`)
+        );
+        """)
+        dbcur.execute(f"SELECT `version` FROM `{TABLE_NAME_MIGRATIONS}`")
+        applied = {row[0] for row in dbcur.fetchall()}
+        dbcon.commit()
+        for version, description, migration in MIGRATIONS:
+            if version in applied:
+                continue
+            logger.info(f"Applying migration {version}: {description}...")
+            migration(dbcon)
+            dbcur.execute(
+                f"INSERT INTO `{TABLE_NAME_MIGRATIONS}` (`version`, `description`) VALUES(%s, %s)",
+                (version, description)
+            )
+            dbcon.commit()
+        logger.info(f"Database schema is at version {MIGRATIONS[-1][0]}.")
+    finally:
+        dbcur.execute("SELECT RELEASE_LOCK('swablu_migrations')")
+        dbcur.fetchall()
+        dbcur.close()
+
+
+database.run_sync(run_migrations)
 
 API_BASE_URL ='https://discordapp.com/api'
 AUTHORIZATION_BASE_URL = API_BASE_URL + '/oauth2/authorize'
 TOKEN_URL = API_BASE_URL + '/oauth2/token'
 
 
-regenerate_htaccess()
+database.run_sync(regenerate_htaccess)
 
 
 def discord_writes_enabled():
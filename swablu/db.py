@@ -0,0 +1,55 @@
+import asyncio
+import functools
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, TypeVar
+
+from mysql.connector import Error as MySQLError
+from mysql.connector.pooling import MySQLConnectionPool, PooledMySQLConnection
+
+T = TypeVar('T')
+logger = logging.getLogger(__name__)
+
+
+class DatabasePool:
+    """
+    A bounded pool of MySQL connections, each used by one worker thread at a time.
+
+    The query helpers in swablu.config are blocking and take a connection as their first argument. Run them via
+    `await pool.run(helper, *args)` so they execute in one of the pool's threads instead of on the event loop
+    (which is shared by the website and the Discord gateway).
+    """
+    def __init__(self, size: int, **connect_kwargs):
+        # One thread per connection: a worker can always get a connection and the pool never runs dry.
+        self._pool = MySQLConnectionPool(pool_name='swablu', pool_size=size, pool_reset_session=True,
+                                         **connect_kwargs)
+        self._executor = ThreadPoolExecutor(max_workers=size, thread_name_prefix='swablu-db')
+
+    def run_sync(self, fn: Callable[..., T], *args, **kwargs) -> T:
+        """Runs fn with a healthy connection from the pool in the calling thread. Only use outside the event loop."""
+        con: PooledMySQLConnection = self._pool.get_connection()
+        try:
+            self._ensure_connected(con)
+            return fn(con, *args, **kwargs)
+        except MySQLError:
+            # Don't leave a half-finished transaction on the connection for the next user.
+            try:
+                con.rollback()
+            except MySQLError:
+                pass
+            raise
+        finally:
+            con.close()
+
+    async def run(self, fn: Callable[..., T], *args, **kwargs) -> T:
+        """Runs fn with a healthy connection from the pool in one of the pool's worker threads."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(self.run_sync, fn, *args, **kwargs))
+
+    @staticmethod
+    def _ensure_connected(con: PooledMySQLConnection):
+        try:
+            con.ping(reconnect=True, attempts=3, delay=1)
+        except MySQLError as ex:
+            logger.warning("Database connection lost and reconnecting failed.", exc_info=ex)
+            raise
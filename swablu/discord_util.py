@@ -1,76 +1,115 @@
-import time
+import hashlib
+import logging
 from typing import Optional
 
 import discord
-from discord import Client, TextChannel, User
+from discord import Client, Message, TextChannel
 
-from swablu.config import DISCORD_GUILD_IDS, discord_client, get_hack_authors
+from swablu.config import get_hack_authors, get_hacks_authors, query_cache
+from swablu.db import DatabasePool
 from swablu.hack_type import get_hack_type_str
+from swablu.member_roles import member_roles
+from swablu.usernames import usernames
 
+# Number of recent messages searched for an already posted message of a hack.
+FIND_MESSAGE_HISTORY_LIMIT = 100
+logger = logging.getLogger(__name__)
 
-async def regenerate_message(dbcon, discord_client: Client, channel_id: int, message_id: Optional['int'], hack: dict):
-    authors = get_hack_author_mentions_str(dbcon, hack['key'])
-    text = f'**{hack["name"]}** by {authors} ({get_hack_type_str(hack["hack_type"])}):\n<https://hacks.skytemple.org/h/{hack["key"]}>'
+
+def hack_message_text(hack: dict, author_mentions: str) -> str:
+    return f'**{hack["name"]}** by {author_mentions} ({get_hack_type_str(hack["hack_type"])}):\n<https://hacks.skytemple.org/h/{hack["key"]}>'
+
+
+def message_hash(text: str) -> str:
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+async def regenerate_message(db: DatabasePool, discord_client: Client, channel_id: int, message_id: Optional['int'], hack: dict) -> tuple[int, str]:
+    """
+    Posts or edits the hack's message in the hack channel. Returns the message ID and the hash of the text, which is
+    stored as `message_hash`. If the text didn't change since it was last posted, Discord isn't contacted at all.
+    Makes a single attempt; retries are up to the caller (see DiscordOutbox).
+    """
+    authors = await get_hack_author_mentions_str(db, hack['key'])
+    text = hack_message_text(hack, authors)
+    text_hash = message_hash(text)
+    if message_id and hack.get('message_hash') == text_hash:
+        return message_id, text_hash
     channel: TextChannel = discord_client.get_channel(channel_id)
-    try_count = 0
-    while try_count < 10:
+    if message_id:
         try:
-            if not message_id:
-                message = await channel.send(text)
-                message_id = message.id
-            else:
-                message = await channel.fetch_message(message_id)
-                if message.content != text:
-                    await message.edit(content=text)
-            break
-        except Exception:
-            try_count += 1
-            if try_count >= 10:
-                raise
-            time.sleep(try_count * 5)
-
-    return message_id
-
-
-def get_hack_author_names_str(dbcon, hack_key: str) -> str:
-    author_ids = get_hack_authors(dbcon, hack_key)
+            # Editing a partial message saves fetching it first.
+            await channel.get_partial_message(message_id).edit(content=text)
+            return message_id, text_hash
+        except discord.NotFound:
+            logger.warning(f"Message of hack {hack['key']} was deleted, posting it again.")
+    # An earlier attempt may have posted the message without its ID being stored. Reuse it instead of posting twice.
+    message = await find_hack_message(discord_client, channel, hack['key'])
+    if message is None:
+        message = await channel.send(text)
+    elif message.content != text:
+        await message.edit(content=text)
+    return message.id, text_hash
+
+
+async def find_hack_message(discord_client: Client, channel: TextChannel, hack_key: str) -> Optional[Message]:
+    """Looks for a recent message of the bot in the channel that is about the given hack."""
+    url = f'<https://hacks.skytemple.org/h/{hack_key}>'
+    async for message in channel.history(limit=FIND_MESSAGE_HISTORY_LIMIT):
+        if message.author == discord_client.user and message.content.endswith(url):
+            return message
+    return None
+
+
+async def get_hack_author_names_str(db: DatabasePool, hack_key: str) -> str:
+    author_ids = await query_cache.run(db, [f'hack-{hack_key}'], get_hack_authors, hack_key)
     author_usernames = get_usernames(author_ids)
     return ", ".join(author_usernames)
 
 
-def get_hack_author_mentions_str(dbcon, hack_key: str) -> str:
-    author_ids = get_hack_authors(dbcon, hack_key)
+async def get_hacks_author_names_str(db: DatabasePool, hack_keys: Optional[list[str]] = None) -> dict[str, str]:
+    """
+    Bulk version of get_hack_author_names_str. Loads the authors of all hacks (or the given hacks) with one query
+    and resolves each distinct author only once. Hacks without authors are not contained in the result.
+    """
+    tags = ['hack'] if hack_keys is None else [f'hack-{key}' for key in hack_keys]
+    authors_by_hack = await query_cache.run(db, tags, get_hacks_authors, hack_keys)
+    author_ids = list({_id for ids in authors_by_hack.values() for _id in ids})
+    usernames = dict(zip(author_ids, get_usernames(author_ids)))
+    return {key: ", ".join(usernames[_id] for _id in ids) for key, ids in authors_by_hack.items()}
+
+
+async def get_hack_author_mentions_str(db: DatabasePool, hack_key: str) -> str:
+    author_ids = await query_cache.run(db, [f'hack-{hack_key}'], get_hack_authors, hack_key)
     author_mentions = [f"<@{_id}>" for _id in author_ids]
     return ", ".join(author_mentions)
 
 
+async def get_hacks_author_mentions_str(db: DatabasePool, hack_keys: Optional[list[str]] = None) -> dict[str, str]:
+    """Bulk version of get_hack_author_mentions_str. Hacks without authors are not contained in the result."""
+    tags = ['hack'] if hack_keys is None else [f'hack-{key}' for key in hack_keys]
+    authors_by_hack = await query_cache.run(db, tags, get_hacks_authors, hack_keys)
+    return {key: ", ".join(f"<@{_id}>" for _id in ids) for key, ids in authors_by_hack.items()}
+
+
 async def has_role(discord_client: discord.Client, user_id: int, role_id: int) -> bool:
     """
     Checks if the given user has the given role on the server set in the config (DISCORD_GUILD_ID environment variable).
+    The roles are cached, see MemberRoleCache.
     :param discord_client: Discord client
     :param user_id: User to check
     :param role_id: Role to check
     :return: True if the user has the specified role, false otherwise
     """
-    guild = discord_client.get_guild(DISCORD_GUILD_IDS[0])
-    role = guild.get_role(role_id)
-    try:
-        user = await guild.fetch_member(user_id)
-    except discord.NotFound:
-        return False
-
-    return role in user.roles
+    return await member_roles.has_role(user_id, role_id)
 
 
 def get_username(discord_id: int) -> str:
-    try:
-        u: User = discord_client.get_user(discord_id)
-        # if the discriminator is 0, they are using the name discord name system.
-        if u.discriminator == "0":
-            return u.name
-        return u.name + '#' + u.discriminator
-    except:
+    """Returns the cached username, or a mention if it isn't known yet. Never does any network I/O."""
+    name = usernames.get(discord_id)
+    if name is None:
         return f'<@{discord_id}>'
+    return name
 
 
 def get_usernames(discord_ids: list[int]) -> list[str]:
@@ -34,3 +34,21 @@ def get_hack_type_str(hack_type):
     if hack_type == "machinima":
         return "Machinima (finished)"
     return "Misc. Hack"
+
+
+# Hack types by the "Type" and "Status" filters of the hack list. Keep in sync with static/filter.js.
+HACK_TYPE_GROUPS = {
+    'balance_hack': ['balance_hack_wip', 'balance_hack_mostly', 'balance_hack'],
+    'gameplay_hack': ['gameplay_hack_wip', 'gameplay_hack_mostly', 'gameplay_hack'],
+    'story_hack': ['story_hack_wip', 'story_hack_mostly', 'story_hack'],
+    'translation': ['translation_wip', 'translation_mostly', 'translation'],
+    'misc_hack': ['misc_hack_wip', 'misc_hack_mostly', 'misc_hack'],
+    'machinima': ['machinima_ongoing', 'machinima'],
+}
+HACK_STATUS_GROUPS = {
+    'wip': ['balance_hack_wip', 'gameplay_hack_wip', 'story_hack_wip', 'translation_wip', 'misc_hack_wip',
+            'machinima_ongoing'],
+    'mostly': ['balance_hack_mostly', 'gameplay_hack_mostly', 'story_hack_mostly', 'translation_mostly',
+               'misc_hack_mostly', 'machinima_ongoing'],
+    'finished': ['balance_hack', 'gameplay_hack', 'story_hack', 'translation', 'misc_hack', 'machinima'],
+}
@@ -0,0 +1,143 @@
+import asyncio
+import io
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+from PIL import Image, ImageOps
+
+from swablu.config import get_screenshot_data, store_screenshot_variants
+from swablu.db import DatabasePool
+
+logger = logging.getLogger(__name__)
+MAX_SCREENSHOT_SIZE = 1000000
+MAX_SCREENSHOT_PIXELS = 4096 * 4096
+SCREENSHOT_FORMATS = {
+    'PNG': 'image/png',
+    'JPEG': 'image/jpeg',
+}
+# Widths of the generated thumbnails. Screenshots narrower than a width don't get a thumbnail of that width.
+THUMBNAIL_WIDTHS = (320, 640)
+IMAGE_WORKERS = int(os.getenv('IMAGE_WORKERS', "2"))
+# Modern formats, most preferred first. They are only generated if Pillow can write them.
+MODERN_FORMATS = {
+    'avif': 'image/avif',
+    'webp': 'image/webp',
+}
+FORMAT_MIMES = MODERN_FORMATS | {
+    'png': 'image/png',
+    'jpeg': 'image/jpeg',
+}
+FORMAT_OPTIONS = {
+    'avif': {'quality': 60},
+    'webp': {'quality': 80, 'method': 6},
+    'png': {'optimize': True},
+    'jpeg': {'quality': 85, 'optimize': True, 'progressive': True},
+}
+image_executor = ThreadPoolExecutor(max_workers=IMAGE_WORKERS, thread_name_prefix='swablu-images')
+_slots = asyncio.Semaphore(IMAGE_WORKERS)
+
+
+class InvalidImageError(ValueError):
+    pass
+
+
+def _sanitize_screenshot(data: bytes) -> tuple[str, bytes]:
+    if len(data) > MAX_SCREENSHOT_SIZE:
+        raise InvalidImageError(f"The image is larger than {MAX_SCREENSHOT_SIZE} bytes.")
+    try:
+        # Only the header is read here, so the dimensions can be checked before anything is decoded.
+        with Image.open(io.BytesIO(data)) as im:
+            if im.format not in SCREENSHOT_FORMATS:
+                raise InvalidImageError(f"Unsupported image format: {im.format}.")
+            if im.width * im.height > MAX_SCREENSHOT_PIXELS:
+                raise InvalidImageError(f"The image is too large ({im.width}x{im.height}).")
+            im.verify()
+        with Image.open(io.BytesIO(data)) as im:
+            fmt = im.format
+            # Re-encoding drops EXIF and text metadata; the orientation from EXIF is applied first.
+            im = ImageOps.exif_transpose(im)
+            buffer = io.BytesIO()
+            if fmt == 'JPEG':
+                if im.mode not in ('L', 'RGB', 'CMYK'):
+                    im = im.convert('RGB')
+                im.save(buffer, 'JPEG', **FORMAT_OPTIONS['jpeg'])
+            else:
+                im.save(buffer, 'PNG', **FORMAT_OPTIONS['png'])
+    except InvalidImageError:
+        raise
+    except (OSError, SyntaxError, ValueError, Image.DecompressionBombError) as ex:
+        raise InvalidImageError(f"The image could not be read: {ex}") from ex
+    return SCREENSHOT_FORMATS[fmt], buffer.getvalue()
+
+
+async def sanitize_screenshot(data: bytes) -> tuple[str, bytes]:
+    """
+    Checks that an uploaded screenshot is a PNG or JPEG image (by its content, not its file name) and re-encodes it
+    without metadata, in the image worker pool. Returns the MIME type and the re-encoded image.
+    Raises InvalidImageError if the upload isn't an acceptable image.
+    """
+    return await asyncio.get_running_loop().run_in_executor(image_executor, _sanitize_screenshot, data)
+
+
+def available_modern_formats() -> list[str]:
+    Image.init()
+    return [fmt for fmt in MODERN_FORMATS if fmt.upper() in Image.SAVE]
+
+
+def generate_variants(data: bytes) -> list[tuple[str, str, bytes]]:
+    """
+    Generates the derivatives of a screenshot as (variant, mime, data) tuples. Variants are named `<size>.<format>`,
+    where size is a thumbnail width or `full`. Thumbnails are also generated in the format of the original (PNG or
+    JPEG) for clients without support for the modern formats.
+    """
+    variants = []
+    with Image.open(io.BytesIO(data)) as original:
+        original.load()
+        base_format = 'jpeg' if original.format == 'JPEG' else 'png'
+        im = original if original.mode in ('RGB', 'RGBA') else original.convert('RGBA')
+        sizes = [('full', im)]
+        for width in THUMBNAIL_WIDTHS:
+            if width < im.width:
+                sizes.append((str(width), im.resize((width, round(im.height * width / im.width)), Image.LANCZOS)))
+        modern_formats = available_modern_formats()
+        for size, img in sizes:
+            formats = modern_formats if size == 'full' else modern_formats + [base_format]
+            for fmt in formats:
+                out = img.convert('RGB') if fmt == 'jpeg' and img.mode != 'RGB' else img
+                buffer = io.BytesIO()
+                out.save(buffer, fmt.upper(), **FORMAT_OPTIONS[fmt])
+                variants.append((f'{size}.{fmt}', FORMAT_MIMES[fmt], buffer.getvalue()))
+    return variants
+
+
+def pick_variant(variants: dict[str, str], width: Optional[int], accept: str) -> Optional[str]:
+    """
+    Picks the variant to serve for a requested display width and Accept header.
+    Returns None if the original should be served.
+    """
+    size = 'full'
+    if width is not None:
+        candidates = [w for w in THUMBNAIL_WIDTHS if w >= width and any(v.startswith(f'{w}.') for v in variants)]
+        if len(candidates) > 0:
+            size = str(min(candidates))
+    for fmt, mime in MODERN_FORMATS.items():
+        if mime in accept and f'{size}.{fmt}' in variants:
+            return f'{size}.{fmt}'
+    for fmt in FORMAT_MIMES:
+        if fmt not in MODERN_FORMATS and f'{size}.{fmt}' in variants:
+            return f'{size}.{fmt}'
+    return None
+
+
+async def create_screenshot_variants(db: DatabasePool, hash: str) -> int:
+    """Generates and stores the derivatives of a stored screenshot. Returns the number of variants."""
+    async with _slots:
+        data = await db.run(get_screenshot_data, hash)
+        if data is None:
+            return 0
+        variants = await asyncio.get_running_loop().run_in_executor(image_executor, generate_variants, data)
+    await db.run(store_screenshot_variants, hash, variants)
+    logger.info(f"Generated {len(variants)} variants of screenshot {hash}.")
+    return len(variants)
@@ -0,0 +1,94 @@
+import asyncio
+import hashlib
+import json
+import logging
+from typing import Optional, Union
+
+from swablu.config import get_jam_configs
+from swablu.db import DatabasePool
+
+logger = logging.getLogger(__name__)
+# Award groups from lowest to highest. A hack listed in several groups of a jam gets the highest one.
+AWARD_GROUPS = ('bronze', 'silver', 'golden')
+
+
+class JamIndex:
+    """
+    Parsed jam configs and an index of the jams each hack is featured in, for the hack list.
+
+    Configs are kept together with their version (the hash of the config text) and are only parsed again if it
+    changes. The index is rebuilt whenever a jam is created or updated via the bot commands, so looking up the
+    featured jams of a hack is a single dict access.
+    """
+    def __init__(self):
+        self._jams: dict[str, tuple[str, dict]] = {}
+        self._featured: dict[str, list[dict]] = {}
+        self._load_task: Optional[asyncio.Task] = None
+        # Updates that came in before the index was loaded. They are applied on top of what was loaded.
+        self._pending: dict[str, Union[str, bytes]] = {}
+
+    async def ensure_loaded(self, db: DatabasePool):
+        if self._load_task is None or (self._load_task.done() and self._load_task.exception() is not None):
+            self._load_task = asyncio.ensure_future(self._load(db))
+        await asyncio.shield(self._load_task)
+
+    def update(self, key: str, config: Union[str, bytes]):
+        """Updates a new or changed jam."""
+        if self._load_task is None or not self._load_task.done():
+            self._pending[key] = config
+            return
+        if self._set(key, config):
+            self._rebuild()
+
+    def featured_jams(self, hack_key: str) -> list[dict]:
+        """Returns the jams the hack is featured in, as dicts with the jam key, name and the hack's award."""
+        return self._featured.get(hack_key, [])
+
+    def jams_with_dq_authors(self, user_ids: set[int]) -> list[str]:
+        """Returns the keys of the jams that list one of the users as author of a disqualified hack."""
+        return [key for key, (_, jam) in self._jams.items()
+                if any(int(dq['author']) in user_ids for dq in jam.get('dq', []))]
+
+    async def _load(self, db: DatabasePool):
+        for key, config in await db.run(get_jam_configs):
+            self._set(key, config)
+        for key, config in self._pending.items():
+            self._set(key, config)
+        self._pending.clear()
+        self._rebuild()
+        logger.info(f"Loaded {len(self._jams)} jams.")
+
+    def _set(self, key: str, config: Union[str, bytes]) -> bool:
+        """Parses and stores the config if its version changed. Returns whether it did."""
+        if isinstance(config, str):
+            config = config.encode('utf-8')
+        version = hashlib.sha1(config).hexdigest()
+        current = self._jams.get(key)
+        if current is not None and current[0] == version:
+            return False
+        try:
+            self._jams[key] = (version, json.loads(config))
+        except ValueError as ex:
+            logger.error(f"Config of jam {key} is invalid.", exc_info=ex)
+            self._jams.pop(key, None)
+        return True
+
+    def _rebuild(self):
+        featured = {}
+        for key, (_, jam) in self._jams.items():
+            awards = {}
+            if 'awards' in jam:
+                for group in AWARD_GROUPS:
+                    for hacks in jam['awards'][group].values():
+                        for hack in hacks:
+                            awards[hack] = group
+            for hack in jam['hacks'].keys():
+                featured.setdefault(hack, []).append({
+                    'key': key,
+                    'name': jam['motto'],
+                    'award': awards.get(hack, 'none'),
+                })
+        self._featured = featured
+
+
+jam_index = JamIndex()
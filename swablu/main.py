@@ -8,13 +8,19 @@ logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
     level=logging.INFO
 )
+# Before anything else starts threads, see start_workers.
+eos_dungeons.start_workers()
 
-from discord import Message
+from discord import Member, Message
 from tornado.web import Application
 
-from swablu.config import discord_client, PORT, DISCORD_BOT_USER_TOKEN, get_template_dir, DISCORD_GUILD_IDS, \
+from swablu.config import database, discord_client, PORT, DISCORD_BOT_USER_TOKEN, get_template_dir, DISCORD_GUILD_IDS, \
     get_static_dir, COOKIE_SECRET, discord_writes_enabled
-from swablu.web import routes
+from swablu.member_roles import member_roles
+from swablu.outbox import outbox
+from swablu.search import search_index
+from swablu.usernames import usernames
+from swablu.web import routes, front_page
 
 
 loop_started = False
@@ -27,6 +33,11 @@ async def on_ready():
     logger.info(f'{discord_client.user} has connected to Discord!')
     if not loop_started:
         loop_started = True
+        asyncio.ensure_future(usernames.start(database))
+        if discord_writes_enabled():
+            outbox.start(database)
+        front_page.schedule()
+        asyncio.ensure_future(search_index.rebuild(database))
         await eos_dungeons.start()
 
 
@@ -41,6 +52,18 @@ async def on_message(message: Message):
             await hacks_mgmnt.process_cmd(message)
 
 
+@discord_client.event
+async def on_member_update(before: Member, after: Member):
+    if after.guild.id == DISCORD_GUILD_IDS[0]:
+        member_roles.update(after)
+
+
+@discord_client.event
+async def on_member_remove(member: Member):
+    if member.guild.id == DISCORD_GUILD_IDS[0]:
+        member_roles.invalidate(member.id)
+
+
 def check_and_remove_message_prefix(message: Message) -> bool:
     if message.content.startswith("<@" + str(discord_client.user.id) + "> "):
         message.content = message.content.removeprefix("<@" + str(discord_client.user.id) + "> ")
@@ -0,0 +1,78 @@
+import asyncio
+import logging
+import time
+from typing import Optional
+
+import discord
+from discord import Member
+
+from swablu.config import discord_client, DISCORD_GUILD_IDS
+
+logger = logging.getLogger(__name__)
+# Seconds the roles of a member are cached for.
+MEMBER_ROLES_TTL = 300
+# Seconds users that aren't members of the server are remembered as such.
+NOT_A_MEMBER_TTL = 60
+
+
+class MemberRoleCache:
+    """
+    Role IDs of the members of the server set in the config, by user ID, for permission checks on the web.
+
+    Members are fetched via the REST API once per MEMBER_ROLES_TTL; concurrent lookups of the same user share one
+    request. With the members intent, the client's gateway cache is kept up to date by Discord, so members in it are
+    read from there instead, and entries are updated when Discord reports a member update (see on_member_update in
+    main). Without it, cached members never get role updates, so it isn't used and role changes apply once the TTL
+    runs out.
+    """
+    def __init__(self):
+        # User ID -> (expiry time, role IDs or None if the user isn't a member)
+        self._roles: dict[int, tuple[float, Optional[frozenset[int]]]] = {}
+        self._fetches: dict[int, asyncio.Future] = {}
+
+    async def get(self, user_id: int) -> Optional[frozenset[int]]:
+        """Returns the IDs of the roles of the user, or None if the user isn't a member of the server."""
+        entry = self._roles.get(user_id)
+        if entry is not None and entry[0] > time.monotonic():
+            return entry[1]
+        guild = discord_client.get_guild(DISCORD_GUILD_IDS[0])
+        if discord_client.intents.members:
+            member = guild.get_member(user_id)
+            if member is not None:
+                return self.update(member)
+        if user_id not in self._fetches:
+            self._fetches[user_id] = asyncio.ensure_future(self._fetch(guild, user_id))
+        return await asyncio.shield(self._fetches[user_id])
+
+    async def has_role(self, user_id: int, role_id: int) -> bool:
+        roles = await self.get(user_id)
+        return roles is not None and role_id in roles
+
+    def update(self, member: Member) -> frozenset[int]:
+        """Stores the current roles of the member."""
+        roles = frozenset(r.id for r in member.roles)
+        self._roles[member.id] = (time.monotonic() + MEMBER_ROLES_TTL, roles)
+        return roles
+
+    def invalidate(self, user_id: int):
+        self._roles.pop(user_id, None)
+
+    async def _fetch(self, guild: discord.Guild, user_id: int) -> Optional[frozenset[int]]:
+        try:
+            return self.update(await guild.fetch_member(user_id))
+        except discord.NotFound:
+            self._roles[user_id] = (time.monotonic() + NOT_A_MEMBER_TTL, None)
+            return None
+        except discord.HTTPException as ex:
+            # Not a reason to treat the user as a non-member (which would e.g. let jury members vote). Fall back to
+            # the expired entry if there is one, otherwise fail. Either way, the next lookup tries again.
+            entry = self._roles.get(user_id)
+            if entry is None:
+                raise
+            logger.warning(f"Fetching member {user_id} failed, using the expired roles: {ex!r}")
+            return entry[1]
+        finally:
+            self._fetches.pop(user_id, None)
+
+
+member_roles = MemberRoleCache()
@@ -0,0 +1,109 @@
+import json
+import secrets
+import time
+from typing import Callable, Optional
+from urllib.parse import urlencode
+
+from tornado.httpclient import AsyncHTTPClient, HTTPRequest, HTTPClientError
+
+from swablu.config import AUTHORIZATION_BASE_URL, TOKEN_URL, OAUTH2_CLIENT_ID, OAUTH2_CLIENT_SECRET, OAUTH2_REDIRECT_URI
+
+CONNECT_TIMEOUT = 5
+REQUEST_TIMEOUT = 15
+# Refresh tokens this many seconds before they actually expire.
+EXPIRY_LEEWAY = 30
+
+
+class OAuth2Error(Exception):
+    pass
+
+
+class InvalidGrantError(OAuth2Error):
+    """The authorization code or refresh token was rejected."""
+
+
+class TokenExpiredError(OAuth2Error):
+    """The access token was rejected and could not be refreshed."""
+
+
+class DiscordOAuth2Session:
+    """
+    Non-blocking OAuth2 client for the Discord login flow, based on Tornado's shared AsyncHTTPClient.
+    Expired tokens are refreshed automatically before requests; the new token is passed to token_updater.
+    """
+    def __init__(self, token: Optional[dict] = None, state: Optional[str] = None, scope: Optional[list[str]] = None,
+                 token_updater: Optional[Callable[[dict], None]] = None):
+        self.token = token
+        self.state = state
+        self.scope = scope
+        self.token_updater = token_updater
+
+    def authorization_url(self) -> tuple[str, str]:
+        if self.state is None:
+            self.state = secrets.token_urlsafe(30)
+        params = {
+            'response_type': 'code',
+            'client_id': OAUTH2_CLIENT_ID,
+            'redirect_uri': OAUTH2_REDIRECT_URI,
+            'state': self.state,
+        }
+        if self.scope:
+            params['scope'] = ' '.join(self.scope)
+        return f'{AUTHORIZATION_BASE_URL}?{urlencode(params)}', self.state
+
+    async def fetch_token(self, code: str) -> dict:
+        self.token = await self._token_request({
+            'grant_type': 'authorization_code',
+            'code': code,
+            'redirect_uri': OAUTH2_REDIRECT_URI,
+        })
+        return self.token
+
+    async def refresh_token(self) -> dict:
+        if not self.token or 'refresh_token' not in self.token:
+            raise TokenExpiredError("No refresh token available.")
+        self.token = await self._token_request({
+            'grant_type': 'refresh_token',
+            'refresh_token': self.token['refresh_token'],
+        })
+        if self.token_updater:
+            self.token_updater(self.token)
+        return self.token
+
+    async def get(self, url: str) -> dict:
+        """Sends an authorized GET request and returns the decoded JSON response."""
+        if not self.token:
+            raise TokenExpiredError("No token.")
+        if 'expires_at' in self.token and self.token['expires_at'] - EXPIRY_LEEWAY < time.time():
+            await self.refresh_token()
+        try:
+            response = await AsyncHTTPClient().fetch(HTTPRequest(
+                url, headers={'Authorization': f'Bearer {self.token["access_token"]}'},
+                connect_timeout=CONNECT_TIMEOUT, request_timeout=REQUEST_TIMEOUT
+            ))
+        except HTTPClientError as ex:
+            if ex.code == 401:
+                raise TokenExpiredError(str(ex)) from ex
+            raise
+        return json.loads(response.body)
+
+    @staticmethod
+    async def _token_request(params: dict) -> dict:
+        params = params | {
+            'client_id': OAUTH2_CLIENT_ID,
+            'client_secret': OAUTH2_CLIENT_SECRET,
+        }
+        try:
+            response = await AsyncHTTPClient().fetch(HTTPRequest(
+                TOKEN_URL, method='POST', body=urlencode(params),
+                headers={'Content-Type': 'application/x-www-form-urlencoded', 'Accept': 'application/json'},
+                connect_timeout=CONNECT_TIMEOUT, request_timeout=REQUEST_TIMEOUT
+            ))
+        except HTTPClientError as ex:
+            if ex.code in (400, 401):
+                raise InvalidGrantError(str(ex)) from ex
+            raise
+        token = json.loads(response.body)
+        if 'expires_in' in token:
+            token['expires_at'] = time.time() + int(token['expires_in'])
+        return token
@@ -0,0 +1,91 @@
+import asyncio
+import datetime
+import logging
+from typing import Callable, Optional
+
+from swablu.config import discord_client, DISCORD_CHANNEL_HACKS, enqueue_discord_write, get_due_discord_writes, \
+    get_next_discord_write_time, finish_discord_write, fail_discord_write, get_rom_hack, set_hack_message, \
+    HackProjection
+from swablu.db import DatabasePool
+from swablu.discord_util import regenerate_message
+
+logger = logging.getLogger(__name__)
+BASE_BACKOFF = 5
+MAX_BACKOFF = 600
+# After this many failed attempts a write is marked as failed and only retried on request (`outbox_retry`).
+MAX_ATTEMPTS = 10
+# Pending writes are checked at least this often, in case another process queued some.
+IDLE_INTERVAL = 60
+
+
+class DiscordOutbox:
+    """
+    Posts and edits the hack channel messages for changes made on the web, in the background.
+
+    Writes are queued in a database table, so they survive restarts, and one queued write per hack is kept: the
+    worker always posts the hack's current state. Failed writes are retried with exponential backoff. Posting is
+    idempotent: if the message ID of a hack wasn't stored, the message is looked up in the channel before a new one
+    is posted (see regenerate_message).
+    """
+    def __init__(self):
+        self._db: Optional[DatabasePool] = None
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        # Called with the hack key after its message was posted or edited.
+        self.on_sent: Optional[Callable[[str], None]] = None
+
+    def start(self, db: DatabasePool):
+        self._db = db
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._run())
+
+    async def enqueue(self, db: DatabasePool, hack_key: str):
+        await db.run(enqueue_discord_write, hack_key)
+        self._wakeup.set()
+
+    def wake_up(self):
+        self._wakeup.set()
+
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            timeout = IDLE_INTERVAL
+            try:
+                for job in await self._db.run(get_due_discord_writes):
+                    await self._process(job)
+                next_attempt_at = await self._db.run(get_next_discord_write_time)
+                if next_attempt_at is not None:
+                    now = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+                    timeout = min(max((next_attempt_at - now).total_seconds(), 0), IDLE_INTERVAL)
+            except Exception as ex:
+                logger.error("Processing the Discord outbox failed.", exc_info=ex)
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _process(self, job: dict):
+        hack_key = job['hack_key']
+        hack = await self._db.run(get_rom_hack, hack_key, HackProjection.SUMMARY)
+        if hack is None:
+            # Deleted in the meantime.
+            await self._db.run(finish_discord_write, hack_key, job['version'])
+            return
+        try:
+            message_id, text_hash = await regenerate_message(
+                self._db, discord_client, DISCORD_CHANNEL_HACKS,
+                int(hack['message_id']) if hack['message_id'] else None, hack
+            )
+        except Exception as ex:
+            backoff = min(BASE_BACKOFF * 2 ** job['attempts'], MAX_BACKOFF)
+            logger.warning(f"Updating the message of hack {hack_key} failed (attempt {job['attempts'] + 1}), "
+                           f"retrying in {backoff}s: {ex!r}")
+            await self._db.run(fail_discord_write, hack_key, job['version'], repr(ex), backoff, MAX_ATTEMPTS)
+            return
+        await self._db.run(set_hack_message, hack_key, message_id, text_hash)
+        await self._db.run(finish_discord_write, hack_key, job['version'])
+        if (message_id, text_hash) != (hack['message_id'], hack['message_hash']) and self.on_sent is not None:
+            self.on_sent(hack_key)
+
+
+outbox = DiscordOutbox()
@@ -0,0 +1,124 @@
+import asyncio
+import logging
+import time
+from typing import Iterable, Optional
+
+logger = logging.getLogger(__name__)
+REQUEST_TIMEOUT = 5
+MAX_TRIES = 6
+MAX_BACKOFF = 30
+
+
+class VarnishPurgeQueue:
+    """
+    Sends xkey purges to Varnish in the background.
+
+    Tags enqueued within `window` seconds are deduplicated and purged with a single request. Requests go over one
+    persistent HTTP/1.1 connection, which is re-opened when it breaks. Failed purges are retried with exponential
+    backoff; tags enqueued meanwhile are merged into the retry.
+    """
+    def __init__(self, host: str, port: int, window: float = 0.5):
+        self.host = host
+        self.port = port
+        self.window = window
+        self._pending: set[str] = set()
+        self._task: Optional[asyncio.Task] = None
+        self._reader: Optional[asyncio.StreamReader] = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+        # Metrics
+        self.purges_sent = 0
+        self.purges_failed = 0
+        self.purge_attempts_failed = 0
+        self.last_latency: Optional[float] = None
+        self.total_latency = 0.0
+
+    def enqueue(self, tags: Iterable[str]):
+        self._pending |= set(tags)
+        if len(self._pending) > 0 and (self._task is None or self._task.done()):
+            self._task = asyncio.ensure_future(self._run())
+
+    def stats(self) -> dict:
+        return {
+            'purges_sent': self.purges_sent,
+            'purges_failed': self.purges_failed,
+            'purge_attempts_failed': self.purge_attempts_failed,
+            'pending_tags': len(self._pending),
+            'last_latency': self.last_latency,
+            'avg_latency': self.total_latency / self.purges_sent if self.purges_sent > 0 else None,
+        }
+
+    async def _run(self):
+        while len(self._pending) > 0:
+            await asyncio.sleep(self.window)
+            tags = self._pending
+            self._pending = set()
+            tries = 0
+            while True:
+                tries += 1
+                start = time.monotonic()
+                try:
+                    await asyncio.wait_for(self._send(tags), REQUEST_TIMEOUT)
+                except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, ValueError) as ex:
+                    self.purge_attempts_failed += 1
+                    await self._close()
+                    if tries >= MAX_TRIES:
+                        self.purges_failed += 1
+                        logger.warning(f'Could not clear cache ({sorted(tags)}), giving up: {ex!r}')
+                        break
+                    backoff = min(0.5 * 2 ** (tries - 1), MAX_BACKOFF)
+                    logger.warning(f'Could not clear cache ({sorted(tags)}), retrying in {backoff}s: {ex!r}')
+                    await asyncio.sleep(backoff)
+                    # Purge everything that came in while waiting together with the retry.
+                    tags |= self._pending
+                    self._pending = set()
+                else:
+                    latency = time.monotonic() - start
+                    self.purges_sent += 1
+                    self.last_latency = latency
+                    self.total_latency += latency
+                    logger.info(f'Cleared cache ({sorted(tags)}) in {latency * 1000:.1f}ms')
+                    break
+
+    async def _send(self, tags: set[str]):
+        if self._writer is None or self._writer.is_closing():
+            self._reader, self._writer = await asyncio.open_connection(self.host, self.port)
+        self._writer.write((
+            f'PURGE / HTTP/1.1\r\n'
+            f'Host: {self.host}\r\n'
+            f'xkey-purge: {" ".join(sorted(tags))}\r\n'
+            f'Content-Length: 0\r\n'
+            f'\r\n'
+        ).encode('ascii'))
+        await self._writer.drain()
+
+        status_line = await self._reader.readline()
+        if not status_line:
+            raise ConnectionResetError("Varnish closed the connection.")
+        status = int(status_line.split(b' ', 2)[1])
+        content_length = 0
+        keep_alive = True
+        while True:
+            line = await self._reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            if name.strip().lower() == 'content-length':
+                content_length = int(value.strip())
+            elif name.strip().lower() == 'connection' and value.strip().lower() == 'close':
+                keep_alive = False
+        if content_length > 0:
+            await self._reader.readexactly(content_length)
+        if not keep_alive:
+            await self._close()
+        if status >= 400:
+            raise ValueError(f"Varnish answered the purge with status {status}.")
+
+    async def _close(self):
+        if self._writer is not None:
+            self._writer.close()
+            try:
+                await self._writer.wait_closed()
+            except OSError:
+                pass
+        self._reader = None
+        self._writer = None
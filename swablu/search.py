@@ -0,0 +1,188 @@
+import asyncio
+import logging
+import re
+from typing import Callable, Iterable, Optional
+
+from swablu.config import get_rom_hacks, get_rom_hacks_by_keys, HackProjection, query_cache
+from swablu.db import DatabasePool
+from swablu.discord_util import get_hacks_author_names_str
+from swablu.hack_type import get_hack_type_str
+
+logger = logging.getLogger(__name__)
+TOKEN_REGEX = re.compile(r'\w+')
+# Weight of a match per field.
+FIELD_WEIGHTS = {
+    'key': 3.0,
+    'name': 3.0,
+    'authors': 2.0,
+    'hack_type': 1.5,
+    'description': 1.0,
+}
+# Fields that are also matched fuzzily (via trigram similarity), to tolerate typos.
+FUZZY_FIELDS = ('name', 'authors')
+MIN_FUZZY_SIMILARITY = 0.4
+
+
+def tokenize(text: Optional[str]) -> list[str]:
+    if not text:
+        return []
+    return TOKEN_REGEX.findall(text.lower())
+
+
+def trigrams(token: str) -> set[str]:
+    padded = f'  {token} '
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def trigram_similarity(a: str, b: str) -> float:
+    ta, tb = trigrams(a), trigrams(b)
+    return len(ta & tb) / len(ta | tb)
+
+
+class _Document:
+    def __init__(self, hack: dict, author_names: str):
+        self.key = hack['key']
+        self.name = hack['name']
+        self.published = hack['message_id'] is not None
+        self.texts = {
+            'key': self.key.lower(),
+            'name': (hack['name'] or '').lower(),
+            'authors': author_names.lower(),
+            'hack_type': f"{hack['hack_type'] or ''} {get_hack_type_str(hack['hack_type'])}".lower(),
+            'description': (hack['description'] or '').lower(),
+        }
+        self.tokens = {field: set(tokenize(text)) for field, text in self.texts.items()}
+        self.trigrams = set()
+        for tokens in self.tokens.values():
+            for token in tokens:
+                self.trigrams |= trigrams(token)
+
+    def score(self, query: str, query_tokens: list[str], fields: Iterable[str]) -> float:
+        """Returns the relevance of this document. 0 if one of the query tokens doesn't match at all."""
+        score = 0.0
+        for qt in query_tokens:
+            best = 0.0
+            for field in fields:
+                tokens = self.tokens[field]
+                if qt in tokens:
+                    s = 1.0
+                elif any(t.startswith(qt) for t in tokens):
+                    s = 0.75
+                elif qt in self.texts[field]:
+                    s = 0.5
+                elif field in FUZZY_FIELDS and len(qt) >= 3:
+                    s = max((trigram_similarity(qt, t) for t in tokens), default=0.0)
+                    s = s * 0.5 if s >= MIN_FUZZY_SIMILARITY else 0.0
+                else:
+                    s = 0.0
+                best = max(best, s * FIELD_WEIGHTS[field])
+            if best == 0.0:
+                return 0.0
+            score += best
+        if query == self.texts['key']:
+            score += 10.0
+        elif query in self.texts['name']:
+            score += 2.0
+        return score
+
+
+class HackSearchIndex:
+    """
+    In-memory search index over hack keys, names, descriptions, hack types and author usernames.
+
+    Candidates are looked up via a trigram index and then ranked per field (exact token, prefix, substring and -
+    for names and authors - fuzzy trigram matches). The index is built once the bot is connected and hacks are
+    re-indexed whenever their `hack-<key>` cache tag is invalidated.
+    """
+    def __init__(self):
+        self._docs: dict[str, _Document] = {}
+        self._by_trigram: dict[str, set[str]] = {}
+        self._pending: set[str] = set()
+        self._task: Optional[asyncio.Task] = None
+        # Called after the index changed, so that cached search results can be invalidated. The hack tags are purged
+        # before re-indexing is done, so results cached in between would be outdated otherwise.
+        self.on_updated: Optional[Callable[[], None]] = None
+
+    async def rebuild(self, db: DatabasePool):
+        hacks = await query_cache.run(db, ['hack'], get_rom_hacks, projection=HackProjection.SUMMARY)
+        authors = await get_hacks_author_names_str(db)
+        self._docs.clear()
+        self._by_trigram.clear()
+        for hack in hacks:
+            self._add(_Document(hack, authors.get(hack['key'], '')))
+        logger.info(f"Built search index for {len(self._docs)} hacks.")
+        if self.on_updated is not None:
+            self.on_updated()
+
+    def schedule_update(self, db: DatabasePool, keys: Iterable[str]):
+        """Re-indexes the given hacks in the background (removing those that no longer exist)."""
+        self._pending |= set(keys)
+        if len(self._pending) > 0 and (self._task is None or self._task.done()):
+            self._task = asyncio.ensure_future(self._run_updates(db))
+
+    def search(self, query: str, limit: int = 20, published_only: bool = True,
+               fields: Iterable[str] = tuple(FIELD_WEIGHTS.keys())) -> list[tuple[float, str, Optional[str]]]:
+        """Returns up to limit (score, key, name) tuples, best match first."""
+        query = query.strip().lower()
+        query_tokens = tokenize(query)
+        if len(query_tokens) < 1:
+            return []
+        candidates = None
+        for qt in query_tokens:
+            if len(qt) < 3:
+                # Too short to be looked up reliably by trigrams.
+                continue
+            keys = set()
+            for trigram in trigrams(qt):
+                keys |= self._by_trigram.get(trigram, set())
+            candidates = keys if candidates is None else candidates & keys
+        if candidates is None:
+            candidates = self._docs.keys()
+        fields = tuple(fields)
+        results = []
+        for key in candidates:
+            doc = self._docs[key]
+            if published_only and not doc.published:
+                continue
+            score = doc.score(query, query_tokens, fields)
+            if score > 0:
+                results.append((score, doc.key, doc.name))
+        results.sort(key=lambda r: (-r[0], r[1]))
+        return results[:limit]
+
+    async def _run_updates(self, db: DatabasePool):
+        while len(self._pending) > 0:
+            keys = list(self._pending)
+            self._pending.clear()
+            try:
+                hacks = await query_cache.run(db, [f'hack-{key}' for key in keys], get_rom_hacks_by_keys, keys,
+                                              HackProjection.SUMMARY)
+                authors = await get_hacks_author_names_str(db, keys)
+            except Exception as ex:
+                logger.error("Updating the search index failed.", exc_info=ex)
+                return
+            for key in keys:
+                self._remove(key)
+            for hack in hacks:
+                self._add(_Document(hack, authors.get(hack['key'], '')))
+            if self.on_updated is not None:
+                self.on_updated()
+
+    def _add(self, doc: _Document):
+        self._docs[doc.key] = doc
+        for trigram in doc.trigrams:
+            self._by_trigram.setdefault(trigram, set()).add(doc.key)
+
+    def _remove(self, key: str):
+        doc = self._docs.pop(key, None)
+        if doc is None:
+            return
+        for trigram in doc.trigrams:
+            keys = self._by_trigram.get(trigram)
+            if keys is not None:
+                keys.discard(key)
+                if len(keys) == 0:
+                    del self._by_trigram[trigram]
+
+
+search_index = HackSearchIndex()
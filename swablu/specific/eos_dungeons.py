@@ -28,11 +28,16 @@ The following strings can be contained in the message and change how the floor i
 
 Example: "@Swablu +onlyfloor +nokecleon +seed:12345"
 """
+import asyncio
 import logging
+import multiprocessing
 import os
 import random
 import shutil
+import threading
 import traceback
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from contextlib import contextmanager
 from io import BytesIO
 from tempfile import TemporaryDirectory
@@ -89,6 +94,14 @@ DTEF_VAR2_FN = 'tileset_2.png'
 STATIC_DATA = Pmd2XmlReader.load_default()
 ITEM_CATEGORIES = STATIC_DATA.dungeon_data.item_categories
 ITEM_CATEGORIES_BY_NAME = {x.name: x for x in ITEM_CATEGORIES.values()}
+BASE_TILESET_FILES = ("base.dma", "base.dpc", "base.dpci", "base.dpl", "base.dpla")
+# Number of processes floors are rendered in. Each of them holds its own copy of the static assets.
+FLOOR_WORKERS = int(os.getenv('EOS_DUNGEONS_WORKERS', "2"))
+
+_pool: Optional[ProcessPoolExecutor] = None
+# Static assets, loaded once per process (see get_base_tileset_files and get_sprite_provider).
+_base_tileset_files: Optional[dict[str, bytes]] = None
+_sprite_provider: Optional['SpriteProvider'] = None
 
 
 class UserError(Exception):
@@ -132,21 +145,82 @@ class DtefProvider:
             self.zip_tmp_ctx.__exit__(exc_type, exc_val, exc_tb)
 
 
+def get_base_tileset_files() -> dict[str, bytes]:
+    global _base_tileset_files
+    if _base_tileset_files is None:
+        files = {}
+        for name in BASE_TILESET_FILES:
+            with open(os.path.join(asset_path(), name), "rb") as f:
+                files[name] = f.read()
+        _base_tileset_files = files
+    return _base_tileset_files
+
+
 def dungeon_data_files() -> Tuple[Dma, Dpc, Dpci, Dpl, Dpla]:
-    with open(os.path.join(asset_path(), "base.dma"), "rb") as f:
-        dma = FileType.DBIN_SIR0_AT4PX_DMA.deserialize(f.read())
-    with open(os.path.join(asset_path(), "base.dpc"), "rb") as f:
-        dpc = FileType.DBIN_AT4PX_DPC.deserialize(f.read())
-    with open(os.path.join(asset_path(), "base.dpci"), "rb") as f:
-        dpci = FileType.DBIN_AT4PX_DPCI.deserialize(f.read())
-    with open(os.path.join(asset_path(), "base.dpl"), "rb") as f:
-        dpl = FileType.DPL.deserialize(f.read())
-    with open(os.path.join(asset_path(), "base.dpla"), "rb") as f:
-        dpla = FileType.DBIN_SIR0_DPLA.deserialize(f.read())
+    # Deserialized for every floor, since the DTEF import modifies the tileset.
+    files = get_base_tileset_files()
+    dma = FileType.DBIN_SIR0_AT4PX_DMA.deserialize(files["base.dma"])
+    dpc = FileType.DBIN_AT4PX_DPC.deserialize(files["base.dpc"])
+    dpci = FileType.DBIN_AT4PX_DPCI.deserialize(files["base.dpci"])
+    dpl = FileType.DPL.deserialize(files["base.dpl"])
+    dpla = FileType.DBIN_SIR0_DPLA.deserialize(files["base.dpla"])
 
     return dma, dpc, dpci, dpl, dpla
 
 
+def get_sprite_provider() -> 'SpriteProvider':
+    global _sprite_provider
+    if _sprite_provider is None:
+        _sprite_provider = SpriteProvider()
+    return _sprite_provider
+
+
+def _init_worker():
+    try:
+        get_base_tileset_files()
+        get_sprite_provider()
+    except Exception as exc:
+        # Loaded again for the first floor, which then reports the error.
+        logger.exception("Failed loading the dungeon assets.", exc_info=exc)
+
+
+def _warm_up() -> int:
+    return os.getpid()
+
+
+def start_workers():
+    """
+    Starts the processes floors are rendered in, so rendering doesn't block the event loop. Must be called by main
+    before any other thread is started: the workers are forked, and a lock held by another thread at that moment would
+    stay locked in them forever. They are forked because the other start methods import the application's main module
+    (and with it the config, which connects to the database) in every worker. This way they start with the skytemple
+    libraries and static data of this process already loaded.
+    """
+    global _pool
+    if not discord_writes_enabled() or _pool is not None:
+        return
+    if threading.active_count() > 1:
+        logger.warning(f"Forking the floor rendering workers while {threading.active_count()} threads are running.")
+    _pool = ProcessPoolExecutor(max_workers=FLOOR_WORKERS, mp_context=multiprocessing.get_context('fork'),
+                                initializer=_init_worker)
+    # The workers are forked on the first submit, the assets are loaded in the background.
+    for _ in range(FLOOR_WORKERS):
+        _pool.submit(_warm_up)
+
+
+async def render_floor_in_pool(options: 'Options', floor_xml_bytes: bytes, dtef_zip_bytes: Optional[bytes]) -> bytes:
+    if _pool is None:
+        raise UserError("Unavailable", "The floor renderer isn't running.")
+    try:
+        return await asyncio.get_running_loop().run_in_executor(
+            _pool, render_floor, options, floor_xml_bytes, dtef_zip_bytes
+        )
+    except BrokenProcessPool as exc:
+        # The workers can't be forked again from the running application, see start_workers.
+        logger.exception("A floor rendering worker died.", exc_info=exc)
+        raise UserError("Unavailable", "The floor renderer crashed and is unavailable until the bot is restarted.")
+
+
 class Options:
     def __init__(self, message: str):
         self.stairs = True
@@ -249,38 +323,9 @@ async def process_message(message: Message) -> bool:
             if floor_xml_bytes is None:
                 raise UserError("Invalid attachments.", "You did not attach a floor XML file. Please attach a floor XML file as well.")
 
-            try:
-                xml = ElementTree.parse(BytesIO(floor_xml_bytes)).getroot()
-            except ParseError as er:
-                raise UserError("XML Error", f"The floor XML you provided can't be parsed: {str(er)}")
-
-            try:
-                floor: MappaFloorProtocol = mappa_floor_from_xml(xml, ITEM_CATEGORIES_BY_NAME)
-            except XmlValidateError as er:
-                raise UserError("XML Error", f"The floor XML you provided is invalid: {str(er)}")
-
-            with DtefProvider(dtef_zip_bytes, floor.layout.tileset_id) as dtef_dir_name:
-                for fname in [DTEF_XML_NAME, DTEF_VAR0_FN, DTEF_VAR1_FN, DTEF_VAR2_FN]:
-                    if not os.path.exists(os.path.join(dtef_dir_name, DTEF_XML_NAME)):
-                        raise UserError("DTEF Error", f"The DTEF ZIP you provided does not contain a {fname} file.")
-
-                tileset: Tuple[Dma, Dpc, Dpci, Dpl, Dpla] = dungeon_data_files()
-                importer = ExplorersDtefImporter(*tileset)
-                try:
-                    importer.do_import(
-                        dtef_dir_name,
-                        os.path.join(dtef_dir_name, DTEF_XML_NAME),
-                        os.path.join(dtef_dir_name, DTEF_VAR0_FN),
-                        os.path.join(dtef_dir_name, DTEF_VAR1_FN),
-                        os.path.join(dtef_dir_name, DTEF_VAR2_FN)
-                    )
-                except ValueError as er:
-                    raise UserError("DTEF Error", f"The DTEF ZIP you provided is invalid: {str(er)}")
-
-                # Now we can finally draw :pogcash:
-                png_file = generate_floor(options, floor, tileset)
-
-                await channel.send(file=File(png_file, "floor.png"))
+            png = await render_floor_in_pool(options, floor_xml_bytes, dtef_zip_bytes)
+
+            await channel.send(file=File(BytesIO(png), "floor.png"))
 
         except UserError as err:
             await channel.send(embed=Embed(
@@ -298,6 +343,40 @@ async def process_message(message: Message) -> bool:
         return True
 
 
+def render_floor(options: Options, floor_xml_bytes: bytes, dtef_zip_bytes: Optional[bytes]) -> bytes:
+    """Imports the tileset and renders the floor. Runs in the worker processes, returns the PNG."""
+    try:
+        xml = ElementTree.parse(BytesIO(floor_xml_bytes)).getroot()
+    except ParseError as er:
+        raise UserError("XML Error", f"The floor XML you provided can't be parsed: {str(er)}")
+
+    try:
+        floor: MappaFloorProtocol = mappa_floor_from_xml(xml, ITEM_CATEGORIES_BY_NAME)
+    except XmlValidateError as er:
+        raise UserError("XML Error", f"The floor XML you provided is invalid: {str(er)}")
+
+    with DtefProvider(dtef_zip_bytes, floor.layout.tileset_id) as dtef_dir_name:
+        for fname in [DTEF_XML_NAME, DTEF_VAR0_FN, DTEF_VAR1_FN, DTEF_VAR2_FN]:
+            if not os.path.exists(os.path.join(dtef_dir_name, DTEF_XML_NAME)):
+                raise UserError("DTEF Error", f"The DTEF ZIP you provided does not contain a {fname} file.")
+
+        tileset: Tuple[Dma, Dpc, Dpci, Dpl, Dpla] = dungeon_data_files()
+        importer = ExplorersDtefImporter(*tileset)
+        try:
+            importer.do_import(
+                dtef_dir_name,
+                os.path.join(dtef_dir_name, DTEF_XML_NAME),
+                os.path.join(dtef_dir_name, DTEF_VAR0_FN),
+                os.path.join(dtef_dir_name, DTEF_VAR1_FN),
+                os.path.join(dtef_dir_name, DTEF_VAR2_FN)
+            )
+        except ValueError as er:
+            raise UserError("DTEF Error", f"The DTEF ZIP you provided is invalid: {str(er)}")
+
+        # Now we can finally draw :pogcash:
+        return generate_floor(options, floor, tileset).getvalue()
+
+
 ####################################
 # Actual drawing code, forked from SkyTemple
 TRAP_PALETTE_MAP = {
@@ -418,7 +497,7 @@ class FixedRoomDrawer:
 
         self.mouse_y = 99999
 
-        self.sprite_provider = SpriteProvider()
+        self.sprite_provider = get_sprite_provider()
 
     def draw_to_png(self) -> BytesIO:
         size_w = (self.fixed_floor.width + 10) * DPC_TILING_DIM * DPCI_TILE_DIM
@@ -1,3 +1,4 @@
+import asyncio
 import json
 import logging
 import re
@@ -8,9 +9,14 @@ from discord.ext.commands import RoleConverter
 from swablu.util import MiniCtx
 
 from swablu.config import database, TABLE_NAME_HACKS, discord_client, discord_writes_enabled, get_jam, get_rom_hack, get_rom_hacks, \
-    jam_exists, update_jam, create_jam, db_cursor, DISCORD_CHANNEL_HACKS, update_hack_authors, get_hack_authors
-from swablu.discord_util import regenerate_message
-from swablu.web import invalidate_jam_cache
+    jam_exists, update_jam, create_jam, db_cursor, DISCORD_CHANNEL_HACKS, update_hack_authors, get_hack_authors, \
+    HackProjection, schedule_htaccess_regeneration, get_screenshots_without_variants, set_hack_message_hash, \
+    get_open_discord_writes, retry_failed_discord_writes
+from swablu.discord_util import get_hacks_author_mentions_str, hack_message_text, message_hash
+from swablu.jams import jam_index
+from swablu.outbox import outbox
+from swablu.search import search_index
+from swablu.web import invalidate_jam_cache, invalidate_cache, purge_queue, generate_screenshot_variants
 
 ALLOWED_ROLES = [
     712704493661192275,  # Admin
@@ -24,27 +30,33 @@ ALLOWED_ROLES_ADMIN = [
     367451227551694852,  # Test server - Admin
 ]
 
+# Number of hack list messages edited at the same time.
+UPDATE_HACK_LIST_CONCURRENCY = 4
+# Seconds between progress reports while updating the hack list.
+PROGRESS_INTERVAL = 5
+# Maximum number of hacks listed by !authors if several match.
+AUTHORS_MATCH_LIMIT = 10
 logger = logging.getLogger(__name__)
 hack_key_regex = re.compile(r"^[0-9a-z_]+$")
 
 
-def create_hack(key: str):
-    cursor = db_cursor(database)
+def create_hack(dbcon, key: str):
+    cursor = db_cursor(dbcon)
     sql = f"INSERT INTO {TABLE_NAME_HACKS} (`key`) VALUES(%s)"
     cursor.execute(sql, (
         key,
     ))
-    database.commit()
+    dbcon.commit()
     cursor.close()
 
 
-def delete_hack(key: str):
-    cursor = db_cursor(database)
+def delete_hack(dbcon, key: str):
+    cursor = db_cursor(dbcon)
     sql = f"DELETE FROM {TABLE_NAME_HACKS} WHERE `key` = %s"
     cursor.execute(sql, (
         key,
     ))
-    database.commit()
+    dbcon.commit()
     cursor.close()
 
 
@@ -60,12 +72,14 @@ async def process_add_hack(message: Message, channel: TextChannel):
             "Invalid hack ID. IDs must only contain numbers, lowercase characters, and underscores."
         )
     
-    if (get_rom_hack(database, key)):
+    if (await database.run(get_rom_hack, key, HackProjection.SUMMARY)):
         raise ValueError(
             "A hack with this ID already exists."
         )
     
-    create_hack(key)
+    await database.run(create_hack, key)
+    invalidate_cache(['hack', f'hack-{key}'])
+    schedule_htaccess_regeneration()
     await channel.send(
         f"New Hack `{key}` created successfully."
     )
@@ -75,7 +89,9 @@ async def process_delete_hack(message: Message, channel: TextChannel):
     cmd_parts = message.content.split(' ')
     if len(cmd_parts) < 2:
         raise ValueError("Missing parameters. Usage: !delete_hack <key>")
-    delete_hack(cmd_parts[1])
+    await database.run(delete_hack, cmd_parts[1])
+    invalidate_cache(['hack', f'hack-{cmd_parts[1]}'])
+    schedule_htaccess_regeneration()
     await channel.send(
         f"Hack `{cmd_parts[1]}` deleted"
     )
@@ -87,7 +103,7 @@ async def process_dump_jam(message: Message, channel: TextChannel):
         raise ValueError("Missing parameters. Usage: !dump_jam <key>")
     jam_key = cmd_parts[1]
 
-    jam = get_jam(database, jam_key)
+    jam = await database.run(get_jam, jam_key)
 
     data = StringIO()
     json.dump(jam, data, indent=2)
@@ -107,10 +123,11 @@ async def process_create_jam(message: Message, channel: TextChannel):
     jam_key = cmd_parts[1]
     jam_data = await message.attachments[0].read()
 
-    if jam_exists(database, jam_key):
+    if await database.run(jam_exists, jam_key):
         raise ValueError("This jam already exists. Use !update_jam.")
 
-    create_jam(database, jam_key, jam_data)
+    await database.run(create_jam, jam_key, jam_data)
+    jam_index.update(jam_key, jam_data)
     invalidate_jam_cache(jam_key, jam_data)
     await channel.send("OK")
 
@@ -124,10 +141,11 @@ async def process_update_jam(message: Message, channel: TextChannel):
     jam_key = cmd_parts[1]
     jam_data = await message.attachments[0].read()
 
-    if not jam_exists(database, jam_key):
+    if not await database.run(jam_exists, jam_key):
         raise ValueError("This jam does not exist. Use !create_jam.")
 
-    update_jam(database, jam_key, jam_data)
+    await database.run(update_jam, jam_key, jam_data)
+    jam_index.update(jam_key, jam_data)
     invalidate_jam_cache(jam_key, jam_data)
     await channel.send("OK")
 
@@ -136,12 +154,60 @@ async def process_update_hack_list(channel: TextChannel):
     if not discord_writes_enabled():
         raise ValueError("Cannot update hack list: Discord writes are disabled in the config.")
 
-    hacks = get_rom_hacks(database)
+    hacks = [hack for hack in await database.run(get_rom_hacks, projection=HackProjection.SUMMARY)
+             if hack['message_id']]
+    mentions = await get_hacks_author_mentions_str(database, [hack['key'] for hack in hacks])
+    # Only messages whose text differs from what was last posted are edited.
+    changed = []
     for hack in hacks:
-        if hack['message_id']:
-            await regenerate_message(database, discord_client, DISCORD_CHANNEL_HACKS, int(hack['message_id']), hack)
-
-    await channel.send("Hack list successfully updated")
+        text = hack_message_text(hack, mentions.get(hack['key'], ''))
+        if message_hash(text) != hack['message_hash']:
+            changed.append((hack, text))
+    unchanged = len(hacks) - len(changed)
+    if len(changed) < 1:
+        await channel.send(f"Hack list is up to date ({unchanged} messages unchanged).")
+        return
+
+    hacks_channel: TextChannel = discord_client.get_channel(DISCORD_CHANNEL_HACKS)
+    queue = asyncio.Queue()
+    for item in changed:
+        queue.put_nowait(item)
+    done = 0
+    failed = 0
+
+    async def worker():
+        nonlocal done, failed
+        while not queue.empty():
+            hack, text = queue.get_nowait()
+            try:
+                # discord.py waits for the rate limit bucket of the channel, shared by all workers.
+                await hacks_channel.get_partial_message(int(hack['message_id'])).edit(content=text)
+                await database.run(set_hack_message_hash, hack['key'], message_hash(text))
+            except Exception as ex:
+                # Counted and skipped, so the other workers don't keep going while the command already failed.
+                logger.warning(f"Updating the message of hack {hack['key']} failed.", exc_info=ex)
+                failed += 1
+            else:
+                done += 1
+
+    def progress_text():
+        return f"Updating hack list: {done}/{len(changed)} messages updated, {unchanged} unchanged, {failed} failed."
+
+    progress = await channel.send(progress_text())
+
+    async def report_progress():
+        while True:
+            await asyncio.sleep(PROGRESS_INTERVAL)
+            await progress.edit(content=progress_text())
+
+    reporter = asyncio.ensure_future(report_progress())
+    try:
+        await asyncio.gather(*(worker() for _ in range(UPDATE_HACK_LIST_CONCURRENCY)))
+    finally:
+        reporter.cancel()
+    await progress.edit(content=progress_text())
+    await channel.send("Hack list successfully updated" if failed == 0 else
+                       f"Hack list updated, but {failed} messages could not be edited.")
 
 
 async def process_get_hack_authors(message: Message, channel: TextChannel):
@@ -154,25 +220,29 @@ async def process_get_hack_authors(message: Message, channel: TextChannel):
 
     requested_hack = " ".join(cmd_parts[1:])
 
-    hacks = get_rom_hacks(database)
-    matched_hacks = []
-    for hack in hacks:
-        if (
-            hack['key'] == requested_hack or
-            hack['name'] is not None and requested_hack.lower() in hack['name'].lower()
-        ):
-            matched_hacks.append(hack)
+    # One more than shown, to know whether the list is truncated.
+    results = search_index.search(requested_hack, limit=AUTHORS_MATCH_LIMIT + 1, published_only=False,
+                                  fields=('key', 'name'))
+    requested_lower = requested_hack.strip().lower()
+    exact_matches = [r for r in results if r[1].lower() == requested_lower]
+    if len(exact_matches) < 1:
+        exact_matches = [r for r in results if r[2] is not None and r[2].strip().lower() == requested_lower]
+    if len(exact_matches) > 0:
+        results = exact_matches
+    matched_hacks = [{'key': key, 'name': name} for _, key, name in results]
 
     if len(matched_hacks) == 0:
         raise ValueError(f"Cannot find a hack with the key or name `{requested_hack}`.")
     elif len(matched_hacks) > 1:
-        matched_hacks_str = "\n".join([f"- {hack['name']}" for hack in matched_hacks])
+        matched_hacks_str = "\n".join([f"- {hack['name']}" for hack in matched_hacks[:AUTHORS_MATCH_LIMIT]])
+        if len(matched_hacks) > AUTHORS_MATCH_LIMIT:
+            matched_hacks_str += f"\n(Only the {AUTHORS_MATCH_LIMIT} best matches are shown.)"
         embed = Embed(description=matched_hacks_str)
 
         await channel.send(f"Multiple hacks match `{requested_hack}`:", embed=embed)
     else:
         hack = matched_hacks[0]
-        authors = get_hack_authors(database, hack['key'])
+        authors = await database.run(get_hack_authors, hack['key'])
 
         if len(authors) == 0:
             await channel.send(f"List of authors for hack `{hack['name']}`:\nNone")
@@ -183,6 +253,39 @@ async def process_get_hack_authors(message: Message, channel: TextChannel):
             await channel.send(f"List of authors for hack `{hack['name']}`:", embed=embed)
 
 
+async def process_purge_stats(channel: TextChannel):
+    stats = purge_queue.stats()
+    lines = [f"{name}: {value if not isinstance(value, float) else f'{value * 1000:.1f}ms'}"
+             for name, value in stats.items()]
+    await channel.send("Varnish purge queue:", embed=Embed(description="\n".join(lines)))
+
+
+async def process_backfill_screenshots(channel: TextChannel):
+    hashes = await database.run(get_screenshots_without_variants)
+    if len(hashes) < 1:
+        await channel.send("All screenshots already have thumbnails.")
+        return
+    await channel.send(f"Generating thumbnails for {len(hashes)} screenshots...")
+    failed = await generate_screenshot_variants(hashes)
+    await channel.send(f"Done. {len(hashes) - failed} screenshots processed, {failed} failed.")
+
+
+async def process_outbox_status(channel: TextChannel):
+    writes = await database.run(get_open_discord_writes)
+    if len(writes) < 1:
+        await channel.send("The Discord outbox is empty.")
+        return
+    lines = [f"`{w['hack_key']}`: {w['status']}, {w['attempts']} failed attempts"
+             f"{', last error: ' + w['last_error'] if w['last_error'] else ''}" for w in writes]
+    await channel.send(f"Discord outbox ({len(writes)} open):", embed=Embed(description="\n".join(lines)[:4000]))
+
+
+async def process_outbox_retry(channel: TextChannel):
+    count = await database.run(retry_failed_discord_writes)
+    outbox.wake_up()
+    await channel.send(f"Retrying {count} failed Discord writes.")
+
+
 async def process_cmd(message: Message):
     if isinstance(message.channel, TextChannel):
         cmd_parts = message.content.split(' ')
@@ -211,6 +314,22 @@ async def process_cmd(message: Message):
                 if not any(r.id in ALLOWED_ROLES for r in message.author.roles):
                     raise RuntimeError("You are not allowed to use this command.")
                 await process_update_hack_list(message.channel)
+            if cmd_parts[0] == 'purge_stats':
+                if not any(r.id in ALLOWED_ROLES for r in message.author.roles):
+                    raise RuntimeError("You are not allowed to use this command.")
+                await process_purge_stats(message.channel)
+            if cmd_parts[0] == 'backfill_screenshots':
+                if not any(r.id in ALLOWED_ROLES_ADMIN for r in message.author.roles):
+                    raise RuntimeError("You are not allowed to use this command.")
+                await process_backfill_screenshots(message.channel)
+            if cmd_parts[0] == 'outbox':
+                if not any(r.id in ALLOWED_ROLES for r in message.author.roles):
+                    raise RuntimeError("You are not allowed to use this command.")
+                await process_outbox_status(message.channel)
+            if cmd_parts[0] == 'outbox_retry':
+                if not any(r.id in ALLOWED_ROLES for r in message.author.roles):
+                    raise RuntimeError("You are not allowed to use this command.")
+                await process_outbox_retry(message.channel)
             if cmd_parts[0] == 'authors':
                 await process_get_hack_authors(message, message.channel)
         except Exception as ex:
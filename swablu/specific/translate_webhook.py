@@ -1,48 +1,86 @@
-import json
+import asyncio
 import logging
+from typing import Optional
 
 import tornado.web
 import tornado.escape
 from discord import Client, TextChannel, Embed, Colour
 
+from swablu.config import discord_client, CROWDIN_AGGREGATION_WINDOW
+
 CHANNEL_ID = 813057591608999957
 logger = logging.getLogger(__name__)
 
 
+class CrowdinAnnouncer:
+    """
+    Collects string events from the Crowdin webhook and announces them in one message per
+    CROWDIN_AGGREGATION_WINDOW seconds. Windows without added strings are not announced.
+    """
+    def __init__(self):
+        self._added = 0
+        self._removed = 0
+        self._task: Optional[asyncio.Task] = None
+
+    def add(self, hooks: list[dict]):
+        for hook in hooks:
+            if hook.get("event") == "string.added":
+                self._added += 1
+            elif hook.get("event") == "string.deleted":
+                self._removed += 1
+        if (self._added > 0 or self._removed > 0) and (self._task is None or self._task.done()):
+            self._task = asyncio.ensure_future(self._run())
+
+    async def _run(self):
+        while self._added > 0 or self._removed > 0:
+            await asyncio.sleep(CROWDIN_AGGREGATION_WINDOW)
+            count_added, count_removed = self._added, self._removed
+            self._added = self._removed = 0
+            if count_added < 1:
+                continue
+            try:
+                await self._send(count_added, count_removed)
+            except Exception as ex:
+                logger.error("Announcing Crowdin updates failed.", exc_info=ex)
+                # Announced together with the next window instead.
+                self._added += count_added
+                self._removed += count_removed
+
+    @staticmethod
+    async def _send(count_added: int, count_removed: int):
+        description = f"{count_added} strings added.\n"
+        if count_removed > 0:
+            description += f"{count_removed} strings removed.\n"
+        embed = Embed(
+            title="Crowdin",
+            description=description,
+            url="https://translate.skytemple.org",
+            colour=Colour.dark_green()
+        )
+        embed.set_author(name="Crowdin", url="https://translate.skytemple.org", icon_url="https://skytemple.org/crowdin.png")
+        channel: TextChannel = discord_client.get_channel(CHANNEL_ID)
+        await channel.send("New Crowdin string updates.", embed=embed)
+
+
+crowdin_announcer = CrowdinAnnouncer()
+
+
 # noinspection PyAttributeOutsideInit,PyAbstractClass
 class TranslateHookHandler(tornado.web.RequestHandler):
+    """Accepts the events and returns right away, they are announced later by CrowdinAnnouncer."""
     def initialize(self, discord_client: Client, *args, **kwargs):
         self.discord_client: Client = discord_client
-        self.channel: TextChannel = self.discord_client.get_channel(CHANNEL_ID)
 
     async def post(self, *args, **kwargs):
-        hook_data = tornado.escape.json_decode(self.request.body)
-        logger.info(hook_data)
-        count_added = 0
-        count_removed = 0
-        description = ""
+        try:
+            hook_data = tornado.escape.json_decode(self.request.body)
+        except ValueError:
+            raise tornado.web.HTTPError(400)
         if 'events' in hook_data:
             hooks = hook_data['events']
         else:
             hooks = [hook_data]
-        for hook in hooks:
-            if hook["event"] == "string.added":
-                count_added += 1
-            elif hook["event"] == "string.deleted":
-                count_removed += 1
-
-        if count_added > 0:
-            description += f"{count_added} strings added.\n"
-        if count_removed > 0:
-            description += f"{count_removed} strings removed.\n"
-
-        if count_added > 0:
-            embed = Embed(
-                title="Crowdin",
-                description=description,
-                url="https://translate.skytemple.org",
-                colour=Colour.dark_green()
-            )
-            embed.set_author(name="Crowdin", url="https://translate.skytemple.org", icon_url="https://skytemple.org/crowdin.png")
-            await self.channel.send("New Crowdin string updates.", embed=embed)
-        return self.write(f"ok.\n{description}\n{json.dumps(hook_data)}")
+        logger.debug(f"Received {len(hooks)} Crowdin events.")
+        crowdin_announcer.add(hooks)
+        self.set_status(202)
+        return self.write("accepted.\n")
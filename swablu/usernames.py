@@ -0,0 +1,166 @@
+import asyncio
+import datetime
+import logging
+import time
+from typing import Callable, Iterable, Optional, Set, Union
+
+import discord
+from discord import Member, User
+
+from swablu.config import discord_client, DISCORD_GUILD_IDS, get_discord_users, store_discord_users, get_hacks_authors
+from swablu.db import DatabasePool
+
+logger = logging.getLogger(__name__)
+# Identities older than this many seconds are fetched again in the background.
+REFRESH_AGE = 7 * 24 * 3600
+REFRESH_INTERVAL = 3600
+# Maximum number of users Discord returns for one gateway member request.
+GATEWAY_BATCH_SIZE = 100
+# Pause between gateway batches and between REST fetches of single users.
+FETCH_INTERVAL = 1.0
+# Pause after a fetch failed (e.g. because of rate limits), before the remaining users are fetched.
+FETCH_BACKOFF = 60
+# Pause before loading the persisted identities again after it failed.
+LOAD_RETRY_INTERVAL = 30
+
+
+def display_name(name: str, discriminator: str) -> str:
+    # if the discriminator is 0, they are using the new discord name system.
+    if discriminator == "0":
+        return name
+    return name + '#' + discriminator
+
+
+class UsernameCache:
+    """
+    Discord usernames by user ID, to show hack authors without the members intent.
+
+    Lookups only read memory and never do network I/O. Unknown IDs are queued and resolved in the background: in
+    batches of up to GATEWAY_BATCH_SIZE via a gateway member request for members of the server, and one by one via
+    the REST API (paced by FETCH_INTERVAL) for everyone else. Resolved identities are persisted, loaded again on
+    startup and refreshed once they are older than REFRESH_AGE.
+    """
+    def __init__(self):
+        self._names: dict[int, str] = {}
+        # When each ID was last resolved, including IDs that turned out not to exist.
+        self._fetched_at: dict[int, float] = {}
+        self._pending: set[int] = set()
+        self._unsaved: list[tuple[int, str, str]] = []
+        # IDs of users whose names were added or changed since on_change was last called.
+        self._changed: Set[int] = set()
+        self._db: Optional[DatabasePool] = None
+        self._task: Optional[asyncio.Task] = None
+        # Called with the IDs of users whose names were added or changed, so that caches of pages showing them can be
+        # invalidated.
+        self.on_change: Optional[Callable[[Set[int]], None]] = None
+
+    async def start(self, db: DatabasePool):
+        """
+        Loads the persisted identities, queues all unknown hack authors and starts the background refresh.
+        Loading is retried until it succeeds; until then, lookups return None.
+        """
+        while True:
+            try:
+                rows = await db.run(get_discord_users)
+                authors = await db.run(get_hacks_authors)
+                break
+            except Exception as ex:
+                logger.error(f"Loading Discord usernames failed, retrying in {LOAD_RETRY_INTERVAL}s.", exc_info=ex)
+                await asyncio.sleep(LOAD_RETRY_INTERVAL)
+        for row in rows:
+            self._names[row['user_id']] = display_name(row['name'], row['discriminator'])
+            self._fetched_at[row['user_id']] = row['fetched_at'].replace(tzinfo=datetime.timezone.utc).timestamp()
+        logger.info(f"Loaded {len(self._names)} Discord usernames.")
+        self._db = db
+        self.request({_id for ids in authors.values() for _id in ids})
+        asyncio.ensure_future(self._refresh_periodically())
+
+    def get(self, user_id: int) -> Optional[str]:
+        """Returns the username, or None if it isn't known (yet). Unknown IDs are queued to be resolved."""
+        name = self._names.get(user_id)
+        if name is None and user_id not in self._fetched_at:
+            # The client's own user cache is in memory as well.
+            user = discord_client.get_user(user_id)
+            if user is not None:
+                self._remember(user)
+                self._schedule()
+                return self._names[user_id]
+            self.request([user_id])
+        return name
+
+    def request(self, user_ids: Iterable[int], refresh: bool = False):
+        """Queues the IDs to be resolved. IDs resolved before are skipped, unless refresh is set."""
+        self._pending |= {_id for _id in user_ids if refresh or _id not in self._fetched_at}
+        self._schedule()
+
+    def _schedule(self):
+        if self._db is not None and (len(self._pending) > 0 or len(self._unsaved) > 0) and \
+                (self._task is None or self._task.done()):
+            self._task = asyncio.ensure_future(self._run())
+
+    async def _run(self):
+        while len(self._pending) > 0 or len(self._unsaved) > 0:
+            user_ids = list(self._pending)
+            self._pending.clear()
+            try:
+                await self._fetch(user_ids)
+            except Exception as ex:
+                logger.error("Resolving Discord usernames failed.", exc_info=ex)
+            unsaved = self._unsaved
+            self._unsaved = []
+            try:
+                await self._db.run(store_discord_users, unsaved)
+            except Exception as ex:
+                logger.error("Storing Discord usernames failed.", exc_info=ex)
+            changed = self._changed
+            self._changed = set()
+            if len(changed) > 0 and self.on_change is not None:
+                self.on_change(changed)
+
+    async def _fetch(self, user_ids: list[int]):
+        missing = set(user_ids)
+        guild = discord_client.get_guild(DISCORD_GUILD_IDS[0])
+        if guild is not None:
+            for i in range(0, len(user_ids), GATEWAY_BATCH_SIZE):
+                batch = user_ids[i:i + GATEWAY_BATCH_SIZE]
+                try:
+                    members = await guild.query_members(user_ids=batch, limit=len(batch), cache=False)
+                except (asyncio.TimeoutError, discord.ClientException) as ex:
+                    logger.warning(f"Requesting {len(batch)} members from the gateway failed: {ex!r}")
+                    members = []
+                for member in members:
+                    self._remember(member)
+                    missing.discard(member.id)
+                await asyncio.sleep(FETCH_INTERVAL)
+        for user_id in missing:
+            try:
+                user = await discord_client.fetch_user(user_id)
+            except discord.NotFound:
+                # Deleted account. Don't ask again until the next refresh.
+                self._fetched_at[user_id] = time.time()
+            except discord.HTTPException as ex:
+                # Not marked as fetched, so it's requested again the next time it's looked up.
+                logger.warning(f"Fetching Discord user {user_id} failed: {ex!r}")
+                await asyncio.sleep(FETCH_BACKOFF)
+            else:
+                self._remember(user)
+            await asyncio.sleep(FETCH_INTERVAL)
+
+    def _remember(self, user: Union[User, Member]):
+        """Stores the user's name, and marks it as changed if it is new or changed."""
+        name = display_name(user.name, user.discriminator)
+        if self._names.get(user.id) != name:
+            self._changed.add(user.id)
+        self._names[user.id] = name
+        self._fetched_at[user.id] = time.time()
+        self._unsaved.append((user.id, user.name, user.discriminator))
+
+    async def _refresh_periodically(self):
+        while True:
+            await asyncio.sleep(REFRESH_INTERVAL)
+            stale_before = time.time() - REFRESH_AGE
+            self.request([_id for _id, fetched_at in self._fetched_at.items() if fetched_at < stale_before],
+                         refresh=True)
+
+
+usernames = UsernameCache()
@@ -1,32 +1,45 @@
-import base64
+import asyncio
+import datetime
+import email.utils
+import hashlib
 import json
 import logging
-import mimetypes
 import re
+import time
 import traceback
 import uuid
 from abc import abstractmethod, ABC
 from asyncio import Future
-from http.client import HTTPConnection
-from random import shuffle
+from random import Random
 from typing import Optional, Union
 
 import tornado.web
-import os
-from requests_oauthlib import OAuth2Session
-from oauthlib.oauth2.rfc6749.errors import InvalidGrantError, TokenExpiredError
-
-from discord import Client, Guild, Member, HTTPException
-from mysql.connector import MySQLConnection
-from tornado import httputil
-
-from swablu.config import discord_client, database, AUTHORIZATION_BASE_URL, OAUTH2_REDIRECT_URI, OAUTH2_CLIENT_ID, \
-    OAUTH2_CLIENT_SECRET, TOKEN_URL, API_BASE_URL, DISCORD_GUILD_IDS, DISCORD_ADMIN_ROLES, get_rom_hacks, \
-    regenerate_htaccess, DISCORD_CHANNEL_HACKS, update_hack, get_rom_hack, get_jam, vote_jam, discord_writes_enabled, \
-    get_jams, get_rom_hack_img, DISCORD_JAM_JURY_ROLE, get_hack_authors, update_hack_authors
-from swablu.discord_util import regenerate_message, has_role, get_usernames, get_hack_author_names_str
-from swablu.hack_type import get_hack_type_str
+
+from discord import Client
+from tornado import httputil, template
+from tornado.httpclient import HTTPClientError
+
+from swablu.compression import CompressedBodyCache, COMPRESSIBLE_TYPES, COMPRESSION_MIN_SIZE, preferred_encoding
+from swablu.config import discord_client, database, API_BASE_URL, DISCORD_ADMIN_ROLES, get_rom_hacks, \
+    update_hack, get_rom_hack, get_jam, vote_jam, discord_writes_enabled, \
+    get_rom_hack_img, DISCORD_JAM_JURY_ROLE, get_hack_authors, update_hack_authors, HackProjection, \
+    get_screenshot_data, store_screenshot, delete_unused_screenshots, query_cache, get_rom_hacks_by_keys, \
+    get_template_dir, VARNISH_HOST, VARNISH_PORT, get_screenshot_variants, get_screenshot_variant_data, get_discord_write, \
+    get_hacks_authors
+from swablu.db import DatabasePool
+from swablu.discord_util import has_role, get_usernames, get_hack_author_names_str, \
+    get_hacks_author_names_str
+from swablu.hack_type import get_hack_type_str, HACK_TYPE_GROUPS, HACK_STATUS_GROUPS
+from swablu.images import create_screenshot_variants, pick_variant, sanitize_screenshot, InvalidImageError, \
+    MAX_SCREENSHOT_SIZE
+from swablu.jams import jam_index
+from swablu.member_roles import member_roles
+from swablu.oauth import DiscordOAuth2Session, InvalidGrantError, TokenExpiredError
+from swablu.outbox import outbox
+from swablu.purge import VarnishPurgeQueue
+from swablu.search import search_index
 from swablu.specific.translate_webhook import TranslateHookHandler
+from swablu.usernames import usernames
 from swablu.util import VotingAllowedStatus
 
 OAUTH_SCOPE = ['identify']
@@ -34,30 +47,27 @@ DEFAULT_AUTHOR_DESCRIPTION = {
     'author': 'Capypara and SkyTemple contributors',
     'description': "ROM editor for Pokémon Mystery Dungeon Explorers of Sky. Lets you edit starters, graphics, scenes, dungeons and more!"
 }
-ALLOWED_MIMES = ['image/jpeg', 'image/png']
-
-if 'http://' in OAUTH2_REDIRECT_URI:
-    os.environ['OAUTHLIB_INSECURE_TRANSPORT'] = 'true'
+# The edit form may contain two screenshots of at most MAX_SCREENSHOT_SIZE bytes each, plus the text fields.
+MAX_EDIT_FORM_SIZE = 2 * MAX_SCREENSHOT_SIZE + 256 * 1024
+# Resolved Discord user IDs are re-validated at the latest after this many seconds, even if the token lives longer.
+USER_ID_CACHE_MAX_AGE = 3600
+# Number of compressed response bodies kept in memory.
+COMPRESSED_BODY_CACHE_SIZE = 256
 logger = logging.getLogger(__name__)
+purge_queue = VarnishPurgeQueue(VARNISH_HOST, VARNISH_PORT)
+compressed_bodies = CompressedBodyCache(COMPRESSED_BODY_CACHE_SIZE)
 
 
 def invalidate_cache(cache_tags):
-    # noinspection PyTypeChecker
-    try:
-        c = HTTPConnection('varnish')
-        c.putrequest('PURGE', '/', skip_host=True)
-        c.putheader('xkey-purge', ' '.join(cache_tags))
-        c.endheaders()
-        c.send('')
-        c.getresponse()
-    except OSError as ex:
-        logger.warning(f'Could not clear cache ({cache_tags}): {ex}')
-    else:
-        logger.info(f'Cleared cache ({cache_tags})')
+    query_cache.invalidate(cache_tags)
+    if 'hack' in cache_tags or 'jam' in cache_tags:
+        front_page.schedule()
+    search_index.schedule_update(database, [tag[len('hack-'):] for tag in cache_tags if tag.startswith('hack-')])
+    purge_queue.enqueue(cache_tags)
 
 
 def invalidate_jam_cache(jam_key: str, jam_data: str):
-    tags_to_purge = [f'jam-{jam_key}']
+    tags_to_purge = ['jam', f'jam-{jam_key}']
 
     jam_data_json = json.loads(jam_data)
     for hack in jam_data_json["hacks"]:
@@ -66,8 +76,36 @@ def invalidate_jam_cache(jam_key: str, jam_data: str):
     invalidate_cache(tags_to_purge)
 
 
+async def invalidate_user_pages(user_ids: set[int]):
+    """Invalidates the pages showing the names of the given users: their hacks, and the jams these are part of."""
+    try:
+        authors_by_hack = await query_cache.run(database, ['hack'], get_hacks_authors)
+        await jam_index.ensure_loaded(database)
+    except Exception as ex:
+        logger.error("Looking up the pages of changed usernames failed.", exc_info=ex)
+        return
+    hack_keys = [key for key, ids in authors_by_hack.items() if not user_ids.isdisjoint(ids)]
+    jam_keys = {jam['key'] for key in hack_keys for jam in jam_index.featured_jams(key)}
+    jam_keys.update(jam_index.jams_with_dq_authors(user_ids))
+    invalidate_cache(['hack', 'jam'] + [f'hack-{key}' for key in hack_keys] + [f'jam-{key}' for key in jam_keys])
+
+
+async def generate_screenshot_variants(hashes: list[str]) -> int:
+    """Generates the derivatives of the given screenshots and purges their cached images. Returns the failure count."""
+    results = await asyncio.gather(*(create_screenshot_variants(database, hash) for hash in hashes),
+                                   return_exceptions=True)
+    failed = 0
+    for hash, result in zip(hashes, results):
+        if isinstance(result, Exception):
+            logger.error(f"Generating the variants of screenshot {hash} failed.", exc_info=result)
+            failed += 1
+    invalidate_cache([f'screenshot-{hash}' for hash in hashes])
+    return failed
+
+
 class SessionTokenProvider:
     tokens = {}
+    user_ids = {}
 
     @classmethod
     def get(cls, session_id):
@@ -78,13 +116,32 @@ class SessionTokenProvider:
     @classmethod
     def set(cls, session_id, token):
         cls.tokens[session_id] = token
+        # A new or refreshed token needs to be validated against Discord again.
+        cls.user_ids.pop(session_id, None)
+
+    @classmethod
+    def get_user_id(cls, session_id) -> Optional[str]:
+        if session_id in cls.user_ids:
+            user_id, expires_at = cls.user_ids[session_id]
+            if expires_at > time.time():
+                return user_id
+            del cls.user_ids[session_id]
+        return None
+
+    @classmethod
+    def set_user_id(cls, session_id, user_id: str):
+        expires_at = time.time() + USER_ID_CACHE_MAX_AGE
+        token = cls.get(session_id)
+        if token and 'expires_at' in token:
+            expires_at = min(expires_at, token['expires_at'])
+        cls.user_ids[session_id] = (user_id, expires_at)
 
 
 # noinspection PyAttributeOutsideInit,PyAbstractClass,PyShadowingNames
 class BaseHandler(tornado.web.RequestHandler, ABC):
-    def initialize(self, discord_client: Client, db: MySQLConnection):
+    def initialize(self, discord_client: Client, db: DatabasePool):
         self.discord_client: Client = discord_client
-        self.db: MySQLConnection = db
+        self.db: DatabasePool = db
         self._allow_auth_without_hacks = False
 
     async def get(self, *args, **kwargs):
@@ -108,20 +165,14 @@ class BaseHandler(tornado.web.RequestHandler, ABC):
         await self.discord_client.wait_until_ready()
 
     def token_updater(self, token):
-        self.set_cookie('oauth2_token', token)
+        if self.get_secure_cookie('session_id'):
+            SessionTokenProvider.set(str(self.get_secure_cookie('session_id'), 'utf-8'), token)
 
-    def make_session(self, token=None, state=None, scope=None) -> OAuth2Session:
-        return OAuth2Session(
-            client_id=OAUTH2_CLIENT_ID,
+    def make_session(self, token=None, state=None, scope=None) -> DiscordOAuth2Session:
+        return DiscordOAuth2Session(
             token=token,
             state=state,
             scope=scope,
-            redirect_uri=OAUTH2_REDIRECT_URI,
-            auto_refresh_kwargs={
-                'client_id': OAUTH2_CLIENT_ID,
-                'client_secret': OAUTH2_CLIENT_SECRET,
-            },
-            auto_refresh_url=TOKEN_URL,
             token_updater=self.token_updater
         )
 
@@ -133,18 +184,85 @@ class CacheableHandler(BaseHandler, ABC):
         super().__init__(application, request, **kwargs)
 
     def set_status(self, status_code: int, reason: Optional[str] = None) -> None:
-        if str(status_code)[0] != 2:
+        # 304 responses must carry the same caching headers as the 200 response they revalidate.
+        if status_code != 304 and str(status_code)[0] != '2':
             self.cacheable = False
         super().set_status(status_code, reason)
 
+    def check_not_modified(self, etag: str, last_modified: Optional[datetime.datetime] = None) -> bool:
+        """
+        Sets the ETag (and Last-Modified) validators of the response. If the client's copy is still current, the
+        response is turned into a 304 and True is returned, so the caller can skip rendering.
+        If-Modified-Since is only evaluated if the request has no If-None-Match.
+        """
+        encoding = self._response_encoding()
+        if encoding is not None:
+            # Compressed and uncompressed bodies are different representations and need different ETags.
+            etag = f'{etag}-{encoding}'
+        self.set_header('Etag', f'"{etag}"')
+        if last_modified is not None:
+            if last_modified.tzinfo is None:
+                last_modified = last_modified.replace(tzinfo=datetime.timezone.utc)
+            self.set_header('Last-Modified', last_modified)
+        if self.request.headers.get('If-None-Match'):
+            not_modified = self.check_etag_header()
+        else:
+            not_modified = last_modified is not None and self._not_modified_since(last_modified)
+        if not_modified:
+            self.set_status(304)
+        return not_modified
+
+    @staticmethod
+    def make_etag(*parts) -> str:
+        """Builds an ETag from the data a response is rendered from."""
+        return hashlib.sha1(json.dumps(parts, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+    def _not_modified_since(self, last_modified: datetime.datetime) -> bool:
+        ims = self.request.headers.get('If-Modified-Since')
+        if not ims:
+            return False
+        try:
+            since = email.utils.parsedate_to_datetime(ims)
+        except (TypeError, ValueError):
+            return False
+        if since.tzinfo is None:
+            since = since.replace(tzinfo=datetime.timezone.utc)
+        return last_modified.replace(microsecond=0) <= since
+
+    def _is_compressible(self) -> bool:
+        content_type = self._headers.get('Content-Type', '')
+        return any(content_type.startswith(t) for t in COMPRESSIBLE_TYPES)
+
+    def _response_encoding(self) -> Optional[str]:
+        """The content encoding the response body will be sent with, if it's large enough to be compressed."""
+        if not self._is_compressible():
+            return None
+        return preferred_encoding(self.request.headers.get('Accept-Encoding', ''))
+
+    def _compress_body(self):
+        if not self._is_compressible():
+            return
+        self.add_header('Vary', 'Accept-Encoding')
+        encoding = self._response_encoding()
+        if self._status_code != 200 or encoding is None or 'Content-Encoding' in self._headers:
+            return
+        body = b''.join(self._write_buffer)
+        if len(body) < COMPRESSION_MIN_SIZE:
+            return
+        self._write_buffer = [compressed_bodies.get(body, encoding)]
+        self.set_header('Content-Encoding', encoding)
+
     def finish(self, chunk: Optional[Union[str, bytes, dict]] = None) -> "Future[None]":
         if self._finished:
             raise RuntimeError("finish() called twice")
+        if chunk is not None:
+            self.write(chunk)
         if self.cacheable and len(self.cache_tags) > 0:
             self.set_header('Cache-Control', 'public, max-age=600, must-revalidate')
             for cache_tag in self.cache_tags:
                 self.add_header('xkey', cache_tag)
-        return super().finish(chunk)
+        self._compress_body()
+        return super().finish()
 
 
 # noinspection PyAbstractClass
@@ -160,49 +278,53 @@ class AuthenticatedHandler(BaseHandler, ABC):
         auth_successful = False
         if self.get_secure_cookie('session_id'):
             sc = str(self.get_secure_cookie('session_id'), 'utf-8')
-            discord = self.make_session(token=SessionTokenProvider.get(sc))
-            try:
-                user = discord.get(API_BASE_URL + '/users/@me').json()
-                if 'id' in user:
-                    user_id = user['id']
-                    auth_successful = True
-                else:
-                    logger.warning(f"OAuth login error: {sc} - {user}")
-            except InvalidGrantError:
-                logger.warning(f"OAuth invalid grant error: {sc}")
-            except TokenExpiredError:
-                logger.warning(f"OAuth token expired error: {sc}")
+            user_id = SessionTokenProvider.get_user_id(sc)
+            if user_id is not None:
+                auth_successful = True
+            else:
+                discord = self.make_session(token=SessionTokenProvider.get(sc))
+                try:
+                    user = await discord.get(API_BASE_URL + '/users/@me')
+                    if 'id' in user:
+                        user_id = user['id']
+                        auth_successful = True
+                        SessionTokenProvider.set_user_id(sc, user_id)
+                    else:
+                        logger.warning(f"OAuth login error: {sc} - {user}")
+                except InvalidGrantError:
+                    logger.warning(f"OAuth invalid grant error: {sc}")
+                except TokenExpiredError:
+                    logger.warning(f"OAuth token expired error: {sc}")
+                except (HTTPClientError, OSError) as ex:
+                    # Discord is rate limiting, unavailable or timed out (also while refreshing the token).
+                    # The user is sent through the login again instead of getting an error page.
+                    logger.warning(f"OAuth request error: {sc} - {ex!r}")
 
         if not auth_successful:
             discord_session = self.make_session(scope=OAUTH_SCOPE)
-            authorization_url, state = discord_session.authorization_url(AUTHORIZATION_BASE_URL)
+            authorization_url, state = discord_session.authorization_url()
             self.set_cookie('oauth2_state', state)
             self.set_secure_cookie('callback_url', self.request.uri)
             self.redirect(authorization_url, permanent=False)
             return False
 
         # Only first guild (SkyTemple) supported
-        guild: Guild = discord_client.get_guild(DISCORD_GUILD_IDS[0])
         self.user_id = user_id
-        member: Member = guild.get_member(int(user_id))
-        if not member:
-            # Try a direct fetch instead, in case the user isn't cached
-            try:
-                member = await guild.fetch_member(int(user_id))
-            except HTTPException:
-                pass
+        roles = await member_roles.get(int(user_id))
 
-        if not member:
+        if roles is None:
             if ignore_no_hacks:
                 return True
             await self.not_authenticated()
             return False
 
-        self.is_admin = any([r.id in DISCORD_ADMIN_ROLES for r in member.roles])
+        self.is_admin = any([r in DISCORD_ADMIN_ROLES for r in roles])
         if self.is_admin:
-            self.hack_access = get_rom_hacks(self.db)
+            self.hack_access = await query_cache.run(self.db, ['hack'], get_rom_hacks,
+                                                     projection=HackProjection.SUMMARY)
         else:
-            self.hack_access = get_rom_hacks(self.db, filter_author_id=user_id)
+            self.hack_access = await query_cache.run(self.db, ['hack'], get_rom_hacks, filter_author_id=user_id,
+                                                     projection=HackProjection.SUMMARY)
         if len(self.hack_access) < 1:
             if ignore_no_hacks:
                 return True
@@ -224,11 +346,7 @@ class CallbackHandler(BaseHandler):
             return self.write(self.get_argument('error'))
         self.set_status(200)
         discord_session = self.make_session(state=self.get_cookie('oauth2_state'))
-        token = discord_session.fetch_token(
-            TOKEN_URL, self.get_argument('code'),
-            client_secret=OAUTH2_CLIENT_SECRET,
-            include_client_id=True
-        )
+        token = await discord_session.fetch_token(self.get_argument('code'))
         session_id = uuid.uuid4().hex
         self.set_secure_cookie('session_id', session_id)
         SessionTokenProvider.set(session_id, token)
@@ -246,55 +364,227 @@ class EditListHandler(AuthenticatedHandler):
                           **DEFAULT_AUTHOR_DESCRIPTION)
 
 
+async def render_list_page(db: DatabasePool) -> bytes:
+    await jam_index.ensure_loaded(db)
+    hacks_pre = await query_cache.run(db, ['hack'], get_rom_hacks, sorted=True, projection=HackProjection.SUMMARY)
+    authors = await get_hacks_author_names_str(db)
+    hacks = []
+    for h in hacks_pre:
+        if h['message_id'] is None:
+            continue
+        h['author'] = authors.get(h['key'], '')
+        h['description'] = h['description'].splitlines()
+        h['hack_type_printable'] = get_hack_type_str(h["hack_type"])
+        h['featured_jams'] = jam_index.featured_jams(h['key'])
+        h['video'] = None  # don't show videos on the list.
+        hacks.append(h)
+    return template_loader.load('list.html').generate(
+        title=f'SkyTemple Hack Directory',
+        hacks=hacks,
+        **DEFAULT_AUTHOR_DESCRIPTION
+    )
+
+
+class FrontPageSnapshot:
+    """
+    The rendered hack list page, kept in memory. Its compressed variants are prepared along with it.
+    It is regenerated in the background whenever a hack or jam changes; requests in the meantime get the previous
+    snapshot. Once a new snapshot is ready, the list page is purged from Varnish again via CACHE_TAG.
+    """
+    CACHE_TAG = 'front-page'
+
+    def __init__(self):
+        self.html: Optional[bytes] = None
+        self.etag: Optional[str] = None
+        self.last_modified: Optional[datetime.datetime] = None
+        self._dirty = False
+        self._task: Optional[asyncio.Task] = None
+
+    def schedule(self):
+        """Requests a regeneration. Requests made while a regeneration is running are coalesced into one more run."""
+        self._dirty = True
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._run())
+
+    async def get(self) -> 'FrontPageSnapshot':
+        """Returns this snapshot, rendering it first if there is none yet."""
+        if self.html is None:
+            self.schedule()
+            await asyncio.shield(self._task)
+            if self.html is None:
+                raise RuntimeError("The hack list could not be rendered.")
+        return self
+
+    async def _run(self):
+        while self._dirty:
+            self._dirty = False
+            try:
+                html = await render_list_page(database)
+            except Exception as ex:
+                logger.error("Rendering the hack list failed.", exc_info=ex)
+                return
+            etag = hashlib.sha1(html).hexdigest()
+            if etag == self.etag:
+                continue
+            had_snapshot = self.html is not None
+            compressed_bodies.prime(html)
+            self.html = html
+            self.etag, self.last_modified = etag, datetime.datetime.now(datetime.timezone.utc)
+            logger.info("Regenerated the hack list.")
+            if had_snapshot:
+                invalidate_cache([self.CACHE_TAG])
+
+
+template_loader = template.Loader(get_template_dir())
+front_page = FrontPageSnapshot()
+usernames.on_change = lambda user_ids: asyncio.ensure_future(invalidate_user_pages(user_ids))
+outbox.on_sent = lambda hack_key: invalidate_cache(['hack', f'hack-{hack_key}'])
+search_index.on_updated = lambda: invalidate_cache([SearchHandler.CACHE_TAG])
+
+
 # noinspection PyAbstractClass
 class ListHandler(CacheableHandler):
     async def do_get(self, **kwargs):
-        jams = get_jams(self.db)
-        hacks_pre = get_rom_hacks(self.db, sorted=True)
-        hacks = []
+        snapshot = await front_page.get()
         self.cache_tags.append(f'hack')
-        for h in hacks_pre:
-            if h['message_id'] is None:
-                continue
-            h['author'] = get_hack_author_names_str(database, h['key'])
-            h['description'] = h['description'].splitlines()
-            h['hack_type_printable'] = get_hack_type_str(h["hack_type"])
-            h['featured_jams'] = []
-            h['video'] = None  # don't show videos on the list.
-            for jam in jams:
-                if h['key'] in jam['hacks'].keys():
-                    h['featured_jams'].append({
-                        'key': jam['key'],
-                        'name': jam['motto'],
-                        'award': 'none' if 'awards' not in jam else self._get_award(h['key'], jam['awards'])
-                    })
-            hacks.append(h)
-        await self.render('list.html',
-                          title=f'SkyTemple Hack Directory',
-                          hacks=hacks,
-                          **DEFAULT_AUTHOR_DESCRIPTION)
+        self.cache_tags.append(f'jam')
+        self.cache_tags.append(FrontPageSnapshot.CACHE_TAG)
+        self.set_header('Content-Type', 'text/html; charset=UTF-8')
+        if self.check_not_modified(snapshot.etag, snapshot.last_modified):
+            return
+        self.write(snapshot.html)
+
+
+# noinspection PyAbstractClass
+class HackListApiHandler(CacheableHandler):
+    """
+    JSON version of the hack list.
+    Query arguments: type, status (see hack_type.HACK_TYPE_GROUPS / HACK_STATUS_GROUPS), name (substring),
+    sort (updated or abc), page (1-based), limit and fields (comma-separated, see FIELDS).
+    """
+    FIELDS = [
+        'key', 'name', 'description', 'author', 'hack_type', 'hack_type_printable', 'url_main', 'url_discord',
+        'url_download', 'video', 'screenshots', 'date_updated'
+    ]
+    DEFAULT_LIMIT = 50
+    MAX_LIMIT = 200
+
+    async def do_get(self, **kwargs):
+        hack_type = self.get_argument('type', '')
+        status = self.get_argument('status', '')
+        sort = self.get_argument('sort', 'updated')
+        name = self.get_argument('name', '').strip().lower()
+        fields = [f for f in self.get_argument('fields', '').split(',') if f != ''] or self.FIELDS
+        try:
+            page = int(self.get_argument('page', '1'))
+            limit = int(self.get_argument('limit', str(self.DEFAULT_LIMIT)))
+        except ValueError:
+            return self._bad_request("page and limit must be numbers.")
+        if hack_type != '' and hack_type not in HACK_TYPE_GROUPS:
+            return self._bad_request(f"Unknown type. Allowed: {', '.join(HACK_TYPE_GROUPS.keys())}")
+        if status != '' and status not in HACK_STATUS_GROUPS:
+            return self._bad_request(f"Unknown status. Allowed: {', '.join(HACK_STATUS_GROUPS.keys())}")
+        if sort not in ('updated', 'abc'):
+            return self._bad_request("Unknown sort. Allowed: updated, abc")
+        if page < 1 or limit < 1 or limit > self.MAX_LIMIT:
+            return self._bad_request(f"page must be >= 1 and limit between 1 and {self.MAX_LIMIT}.")
+        unknown_fields = [f for f in fields if f not in self.FIELDS]
+        if len(unknown_fields) > 0:
+            return self._bad_request(f"Unknown fields: {', '.join(unknown_fields)}")
+
+        self.cache_tags.append('hack')
+        hacks = await query_cache.run(self.db, ['hack'], get_rom_hacks, sorted=True,
+                                      projection=HackProjection.SUMMARY)
+        hacks = [h for h in hacks if h['message_id'] is not None]
+        if hack_type != '':
+            hacks = [h for h in hacks if h['hack_type'] in HACK_TYPE_GROUPS[hack_type]]
+        if status != '':
+            hacks = [h for h in hacks if h['hack_type'] in HACK_STATUS_GROUPS[status]]
+        if name != '':
+            hacks = [h for h in hacks if name in _hack_sort_name(h['name']).lower()]
+        if sort == 'abc':
+            hacks.sort(key=lambda h: _hack_sort_name(h['name']))
+
+        total = len(hacks)
+        hacks = hacks[(page - 1) * limit:page * limit]
+        authors = {}
+        if 'author' in fields:
+            authors = await get_hacks_author_names_str(self.db, [h['key'] for h in hacks])
+
+        self.set_header('Content-Type', 'application/json; charset=UTF-8')
+        self.write(json.dumps({
+            'total': total,
+            'page': page,
+            'limit': limit,
+            'hacks': [self._hack_to_json(h, fields, authors) for h in hacks],
+        }, sort_keys=True))
 
     @staticmethod
-    def _get_award(key, awards):
-        for x in awards['golden'].values():
-            if key in x:
-                return 'golden'
-        for x in awards['silver'].values():
-            if key in x:
-                return 'silver'
-        for x in awards['bronze'].values():
-            if key in x:
-                return 'bronze'
-        return 'none'
+    def _hack_to_json(hack, fields, authors) -> dict:
+        d = {}
+        for field in fields:
+            if field == 'author':
+                d[field] = authors.get(hack['key'], '')
+            elif field == 'hack_type_printable':
+                d[field] = get_hack_type_str(hack['hack_type'])
+            elif field == 'screenshots':
+                d[field] = [f'/himg/{hack["key"]}/{i}.png' for i in (1, 2) if hack[f'has_screenshot{i}']]
+            elif field == 'date_updated':
+                d[field] = hack['date_updated'].isoformat() if hack['date_updated'] else None
+            else:
+                d[field] = hack[field]
+        return d
+
+    def _bad_request(self, message: str):
+        self.set_status(400)
+        self.set_header('Content-Type', 'application/json; charset=UTF-8')
+        self.write(json.dumps({'error': message}))
+
+
+# noinspection PyAbstractClass
+class SearchHandler(CacheableHandler):
+    """Ranked search over published hacks (name, description, hack type and authors). Query arguments: q, limit."""
+    MAX_LIMIT = 50
+    # Purged again once the search index is updated, see HackSearchIndex.on_updated.
+    CACHE_TAG = 'search'
+
+    async def do_get(self, **kwargs):
+        query = self.get_argument('q', '')
+        try:
+            limit = min(max(int(self.get_argument('limit', '20')), 1), self.MAX_LIMIT)
+        except ValueError:
+            limit = 20
+        self.cache_tags.append('hack')
+        self.cache_tags.append(self.CACHE_TAG)
+        self.set_header('Content-Type', 'application/json; charset=UTF-8')
+        self.write(json.dumps({
+            'query': query,
+            'results': [
+                {'key': key, 'name': name, 'score': round(score, 3), 'url': f'/h/{key}'}
+                for score, key, name in search_index.search(query, limit)
+            ]
+        }))
+
+
+def _hack_sort_name(name: Optional[str]) -> str:
+    # Same as the data-name attribute used by static/filter.js.
+    if name is None:
+        return ''
+    return name.replace('Pokemon Mystery Dungeon', '').replace('Pokémon Mystery Dungeon', '').replace('PMD', '') \
+        .strip(':').strip()
 
 
 # noinspection PyAbstractClass
 class HackEntryHandler(CacheableHandler):
     async def do_get(self, **kwargs):
-        hack = get_rom_hack(self.db, kwargs['hack_id'])
+        hack = await query_cache.run(self.db, [f'hack-{kwargs["hack_id"]}'], get_rom_hack, kwargs['hack_id'],
+                                     HackProjection.SUMMARY)
         if hack and hack['message_id']:
             self.cache_tags.append(f'hack-{hack["key"]}')
-            authors = get_hack_author_names_str(database, hack['key'])
+            authors = await get_hack_author_names_str(self.db, hack['key'])
+            # No Last-Modified: silent edits and author or username changes don't update date_updated.
+            if self.check_not_modified(self.make_etag(hack, authors)):
+                return
             desc = hack['description']
             description_lines = desc.splitlines()
             await self.render('hack_entry.html',
@@ -311,13 +601,31 @@ class HackEntryHandler(CacheableHandler):
 # noinspection PyAbstractClass
 class HackImageHandler(CacheableHandler):
     async def do_get(self, **kwargs):
-        hack_img = get_rom_hack_img(self.db, kwargs['hack_id'], kwargs['img_id'])
+        hack_img = await query_cache.run(self.db, [f'hack-{kwargs["hack_id"]}'], get_rom_hack_img,
+                                         kwargs['hack_id'], kwargs['img_id'])
         if hack_img is not None:
+            hash = hack_img['hash']
             self.cache_tags.append(f'hack-{kwargs["hack_id"]}')
-            prefix, data = hack_img.split(',')
-            self.set_header('Content-Type', prefix.split(':')[1].split(';')[0])
-            self.write(base64.b64decode(data))
-            return
+            self.cache_tags.append(f'screenshot-{hash}')
+            variants = await query_cache.run(self.db, [f'screenshot-{hash}'], get_screenshot_variants, hash)
+            try:
+                width = int(self.get_query_argument('w', ''))
+            except ValueError:
+                width = None
+            if len(variants) > 0:
+                self.set_header('Vary', 'Accept')
+            variant = pick_variant(variants, width, self.request.headers.get('Accept', ''))
+            self.set_header('Content-Type', variants[variant] if variant else hack_img['mime'])
+            # Screenshots are content-addressed, so the hash is a strong validator.
+            if self.check_not_modified(f'{hash}-{variant}' if variant else hash):
+                return
+            if variant:
+                data = await self.db.run(get_screenshot_variant_data, hash, variant)
+            else:
+                data = await self.db.run(get_screenshot_data, hash)
+            if data is not None:
+                self.write(data)
+                return
         self.write('404: Not Found')
         self.set_status(404, 'Not Found')
 
@@ -327,7 +635,7 @@ class JamHandler(CacheableHandler):
     async def do_get(self, **kwargs):
         jam = None
         try:
-            jam = get_jam(self.db, kwargs['jam_key'])
+            jam = await query_cache.run(self.db, [f'jam-{kwargs["jam_key"]}'], get_jam, kwargs['jam_key'])
         except Exception as ex:
             logger.warning("Jam error.", exc_info=ex)
 
@@ -335,29 +643,22 @@ class JamHandler(CacheableHandler):
             self.cache_tags.append(f'jam-{kwargs["jam_key"]}')
             if 'voting_enabled' not in jam:
                 jam['voting_enabled'] = False
-            left = list(jam['hacks'].keys())
-            winners = []
-            if 'awards' in jam:
-                for award, hacks in (jam['awards']['golden'] | jam['awards']['silver'] | jam['awards']['bronze']).items():
-                    for hack in hacks:
-                        if hack in left:
-                            winners.append(hack)
-                            left.remove(hack)
-            hackdata = {}
-            for hack in jam['hacks'].keys():
+            award_index = self._award_index(jam)
+            winners = [hack for hack in award_index.keys() if hack in jam['hacks']]
+            left = [hack for hack in jam['hacks'].keys() if hack not in award_index]
+            hack_keys = list(jam['hacks'].keys())
+            authors = await get_hacks_author_names_str(self.db, hack_keys)
+            hack_rows = await query_cache.run(self.db, [f'hack-{hack}' for hack in hack_keys],
+                                              get_rom_hacks_by_keys, hack_keys, HackProjection.SUMMARY)
+            hackdata = {row['key']: row for row in hack_rows}
+            for hack in hack_keys:
                 self.cache_tags.append(f'hack-{hack}')
-                hackdata[hack] = get_rom_hack(self.db, hack)
-                hackdata[hack]['author'] = get_hack_author_names_str(database, hack)
+                hackdata[hack]['author'] = authors.get(hack, '')
                 hackdata[hack]['description'] = hackdata[hack]['description'].splitlines()
-                hackdata[hack]['awards'] = []
-                if 'awards' in jam:
-                    for award, hacks in (jam['awards']['golden'] | jam['awards']['silver'] | jam['awards']['bronze']).items():
-                        for ahack in hacks:
-                            if ahack == hack:
-                                hackdata[hack]['awards'].append(award)
+                hackdata[hack]['awards'] = award_index.get(hack, [])
             for dq in jam['dq']:
-                member = discord_client.get_user(int(dq['author']))
-                dq['author'] = "???" if member is None else member.name
+                name = usernames.get(int(dq['author']))
+                dq['author'] = "???" if name is None else name
             award_groups = {}
             if 'awards' in jam:
                 for award in jam['awards']['golden'].keys():
@@ -366,7 +667,11 @@ class JamHandler(CacheableHandler):
                     award_groups[award] = 'silver'
                 for award in jam['awards']['bronze'].keys():
                     award_groups[award] = 'bronze'
-            shuffle(left)
+            etag = self.make_etag(jam, hackdata)
+            if self.check_not_modified(etag):
+                return
+            # Seeded by the ETag, so that responses with the same (strong) ETag have the same content.
+            Random(etag).shuffle(left)
             await self.render('jam.html',
                               jam_key=kwargs['jam_key'],
                               title=f'SkyTemple Hack Jam - {jam["motto"]}',
@@ -380,6 +685,16 @@ class JamHandler(CacheableHandler):
             return
         return self.redirect('https://skytemple.org')
 
+    @staticmethod
+    def _award_index(jam) -> dict[str, list[str]]:
+        """Maps each awarded hack to its awards, in the order they first appear in the jam's award lists."""
+        index = {}
+        if 'awards' in jam:
+            for award, hacks in (jam['awards']['golden'] | jam['awards']['silver'] | jam['awards']['bronze']).items():
+                for hack in hacks:
+                    index.setdefault(hack, []).append(award)
+        return index
+
 
 # noinspection PyAbstractClass
 class JamVoteHandler(AuthenticatedHandler):
@@ -391,8 +706,9 @@ class JamVoteHandler(AuthenticatedHandler):
         jam = None
         hack = None
         try:
-            hack = get_rom_hack(self.db, kwargs['hack_id'])
-            jam = get_jam(self.db, kwargs['jam_key'])
+            hack = await query_cache.run(self.db, [f'hack-{kwargs["hack_id"]}'], get_rom_hack, kwargs['hack_id'],
+                                         HackProjection.SUMMARY)
+            jam = await query_cache.run(self.db, [f'jam-{kwargs["jam_key"]}'], get_jam, kwargs['jam_key'])
         except Exception as ex:
             logger.warning("Jam vote error.", exc_info=ex)
 
@@ -402,7 +718,7 @@ class JamVoteHandler(AuthenticatedHandler):
             voting_allowed = await self._voting_allowed(jam, self.user_id)
             if voting_allowed == VotingAllowedStatus.ALLOWED:
                 try:
-                    vote_jam(self.db, kwargs['jam_key'], self.user_id, kwargs['hack_id'])
+                    await self.db.run(vote_jam, kwargs['jam_key'], self.user_id, kwargs['hack_id'])
                 except:
                     logger.error("Jam vote error.", exc_info=ex)
                     raise
@@ -434,8 +750,27 @@ class JamVoteHandler(AuthenticatedHandler):
 
 
 # noinspection PyAbstractClass
+@tornado.web.stream_request_body
 class EditFormHandler(AuthenticatedHandler):
+    """
+    The request body is streamed into a buffer that is bounded by MAX_EDIT_FORM_SIZE, so oversized uploads are
+    rejected before they are read completely (or at all, if they announce their size).
+    """
+    async def prepare(self):
+        await super().prepare()
+        if self.request.method == 'POST':
+            if int(self.request.headers.get('Content-Length', 0)) > MAX_EDIT_FORM_SIZE:
+                raise tornado.web.HTTPError(413)
+            self.request.connection.set_max_body_size(MAX_EDIT_FORM_SIZE)
+            self._form_body = bytearray()
+
+    def data_received(self, chunk: bytes):
+        self._form_body += chunk
+
     async def post(self, hack_id):
+        httputil.parse_body_arguments(self.request.headers.get('Content-Type', ''), bytes(self._form_body),
+                                      self.request.body_arguments, self.request.files, self.request.headers)
+        self._form_body = None
         key = self.get_body_argument('key', '')
         if not await self.auth():
             return
@@ -456,7 +791,8 @@ class EditFormHandler(AuthenticatedHandler):
             # Missing required arguments
             if self.is_admin:
                 # At least update the author list
-                self._try_update_hack_authors(hack_id, hack)
+                await self._try_update_hack_authors(hack_id, hack)
+                invalidate_cache(['hack', f'hack-{hack_id}'])
                 return self.redirect(f'/edit/{hack_id}?saved_authors_only=1')
 
             return self.redirect(f'/edit/{hack_id}?missing_arg=1')
@@ -470,18 +806,26 @@ class EditFormHandler(AuthenticatedHandler):
         screenshot2 = self.request.files.get('screenshot2', None)
         delete_screenshot_1 = self.get_body_argument('delscreenshot1', '') != ''
         delete_screenshot_2 = self.get_body_argument('delscreenshot2', '') != ''
+        # Both screenshots are validated before either is stored.
+        try:
+            if screenshot1 and not delete_screenshot_1:
+                screenshot1 = await sanitize_screenshot(screenshot1[0]['body'])
+            if screenshot2 and not delete_screenshot_2:
+                screenshot2 = await sanitize_screenshot(screenshot2[0]['body'])
+        except InvalidImageError as ex:
+            logger.info(f"Rejected screenshot for {hack_id}: {ex}")
+            return self.redirect(f'/edit/{hack_id}?invalid_screenshot=1')
+        new_screenshots = []
         if delete_screenshot_1:
-            hack['screenshot1'] = None
+            hack['screenshot1_hash'] = None
         elif screenshot1:
-            mime = mimetypes.guess_type(screenshot1[0]['filename'])[0] or "application/octet-stream"
-            if mime in ALLOWED_MIMES and len(screenshot1[0]["body"]) <= 1000000:
-                hack['screenshot1'] = f'data:{mime};base64,{str(base64.b64encode(screenshot1[0]["body"]), "ascii")}'
+            hack['screenshot1_hash'] = await self.db.run(store_screenshot, *screenshot1)
+            new_screenshots.append(hack['screenshot1_hash'])
         if delete_screenshot_2:
-            hack['screenshot2'] = None
+            hack['screenshot2_hash'] = None
         elif screenshot2:
-            mime = mimetypes.guess_type(screenshot2[0]['filename'])[0] or "application/octet-stream"
-            if mime in ALLOWED_MIMES and len(screenshot2[0]["body"]) <= 1000000:
-                hack['screenshot2'] = f'data:{mime};base64,{str(base64.b64encode(screenshot2[0]["body"]), "ascii")}'
+            hack['screenshot2_hash'] = await self.db.run(store_screenshot, *screenshot2)
+            new_screenshots.append(hack['screenshot2_hash'])
         hack['video'] = self.get_body_argument('video', '')
         regex = re.compile(r'^.*((youtu.be\/)|(v\/)|(\/u\/\w\/)|(embed\/)|(watch\?))\??v?=?([^#&?]*).*')
         m = regex.match(hack['video'])
@@ -489,19 +833,20 @@ class EditFormHandler(AuthenticatedHandler):
             hack['video'] = m.group(7)
 
         if self.is_admin:
-            self._try_update_hack_authors(hack_id, hack)
-
-        if discord_writes_enabled():
-            hack['message_id'] = await regenerate_message(database, self.discord_client, DISCORD_CHANNEL_HACKS,
-                                                          int(hack['message_id']) if hack['message_id'] else None, hack)
+            await self._try_update_hack_authors(hack_id, hack)
 
         silent_edit = editing and self.get_body_argument('silent', '') != ''
-        update_hack(self.db, hack, silent_edit)
+        await self.db.run(update_hack, hack, silent_edit)
+        await self.db.run(delete_unused_screenshots)
         invalidate_cache(['hack', f'hack-{hack_id}'])
-        regenerate_htaccess()
+        if discord_writes_enabled():
+            # The message in the hack channel is posted / edited in the background.
+            await outbox.enqueue(self.db, hack_id)
+        if len(new_screenshots) > 0:
+            asyncio.ensure_future(generate_screenshot_variants(new_screenshots))
         return self.redirect(f'/edit/{hack_id}?saved=1')
 
-    def _try_update_hack_authors(self, hack_id: str, hack: dict):
+    async def _try_update_hack_authors(self, hack_id: str, hack: dict):
         authors = self.get_body_argument('authors', '').replace(" ", "")
         if authors == "":
             author_ids = []
@@ -512,20 +857,22 @@ class EditFormHandler(AuthenticatedHandler):
                 return self.redirect(f'/edit/{hack_id}?invalid_author_list=1')
 
         if self.is_admin:
-            update_hack_authors(self.db, hack['key'], author_ids)
+            await self.db.run(update_hack_authors, hack['key'], author_ids)
 
     async def do_get(self, **kwargs):
         for hack in self.hack_access:
             if hack['key'] == kwargs['hack_id']:
                 if self.is_admin:
-                    author_ids = get_hack_authors(database, hack['key'])
+                    author_ids = await query_cache.run(self.db, [f'hack-{hack["key"]}'], get_hack_authors, hack['key'])
                     author_names = get_usernames(author_ids)
 
-                    author_ids_str = ",".join([str(_id) for _id in get_hack_authors(database, hack['key'])])
+                    author_ids_str = ",".join([str(_id) for _id in author_ids])
                     authors = [val for val in zip(author_ids, author_names)]
+                    discord_write = await self.db.run(get_discord_write, hack['key'])
                 else:
                     author_ids_str = ""
                     authors = []
+                    discord_write = None
 
                 await self.render('edit-form.html',
                                   title='SkyTemple - Edit ROM Hack',
@@ -538,6 +885,8 @@ class EditFormHandler(AuthenticatedHandler):
                                   authors=authors,
                                   invalid_download_link=bool(self.get_argument('invalid_download_link', '')),
                                   invalid_author_list=bool(self.get_argument('invalid_author_list', '')),
+                                  invalid_screenshot=bool(self.get_argument('invalid_screenshot', '')),
+                                  discord_write=discord_write,
                                   **DEFAULT_AUTHOR_DESCRIPTION)
                 return
         return self.redirect('/edit')
@@ -551,6 +900,8 @@ extra = {
 routes = [
     (r"/", ListHandler, extra),
     (r"/callback/?", CallbackHandler, extra),
+    (r"/api/hacks/?", HackListApiHandler, extra),
+    (r"/search/?", SearchHandler, extra),
     (r"/h/(?P<hack_id>[^\/]+)/?", HackEntryHandler, extra),
     (r"/himg/(?P<hack_id>[^\/]+)/(?P<img_id>\d).png", HackImageHandler, extra),
     (r"/jam/(?P<jam_key>[^\/]+)/?", JamHandler, extra),